@@ -0,0 +1,89 @@
+"""Checksums of uploaded files, computed while the data is streamed to the disk.
+
+Clients can send the expected checksum in an Upload-Checksum header (or in a part header of a multipart upload),
+in the form of <algorithm>=<hexdigest>, e.g. Upload-Checksum: sha256=9f86d081884c7d65...
+"""
+import os
+import hashlib
+
+from .error import AbortRequest
+
+CHECKSUM_HEADER = "Upload-Checksum"
+
+# Algorithm name -> (tag used in checksum files, constructor)
+ALGORITHMS = {
+    "sha256": ("SHA256", hashlib.sha256),
+    "blake2b": ("BLAKE2b", hashlib.blake2b),
+}
+
+READ_BLOCK_SIZE = 1024 * 1024
+
+
+def parse_checksum(value):
+    """Parse the value of an Upload-Checksum header.
+
+    :return: A tuple of (algorithm, hexdigest)
+    """
+    algorithm, sep, hexdigest = value.strip().partition("=")
+    algorithm, hexdigest = algorithm.strip().lower(), hexdigest.strip().lower()
+    if not sep or algorithm not in ALGORITHMS:
+        raise AbortRequest(400, "Bad Request - unsupported checksum algorithm, use one of: %s." %
+                           ", ".join(sorted(ALGORITHMS)))
+    try:
+        bytes.fromhex(hexdigest)
+    except ValueError:
+        raise AbortRequest(400, "Bad Request - invalid checksum.")
+    return algorithm, hexdigest
+
+
+def update_from_file(path, checksums):
+    """Compute checksums from a file instead of a stream, reading the file only once."""
+    with open(path, "rb") as fin:
+        for block in iter(lambda: fin.read(READ_BLOCK_SIZE), b""):
+            for checksum in checksums:
+                checksum.update(block)
+
+
+class StreamingChecksum(object):
+    """Incrementally computed checksum of an upload, optionally verified against the digest sent by the client."""
+
+    def __init__(self, algorithm, expected=None):
+        self.algorithm = algorithm
+        self.expected = expected
+        self.tag, constructor = ALGORITHMS[algorithm]
+        self._hash = constructor()
+
+    @classmethod
+    def create(cls, header_value, default_algorithm):
+        """Create a checksum for an upload.
+
+        :param header_value: Value of the Upload-Checksum header sent by the client, or None.
+        :param default_algorithm: Algorithm to be used when the client did not send a checksum, or "none".
+        :return: A new StreamingChecksum, or None when no checksum is needed.
+        """
+        if header_value:
+            return cls(*parse_checksum(header_value))
+        elif default_algorithm and default_algorithm != "none":
+            return cls(default_algorithm)
+        else:
+            return None
+
+    def update(self, data):
+        self._hash.update(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def verify(self):
+        """Raise AbortRequest when the checksum does not match the one sent by the client."""
+        if self.expected is not None and self.expected != self.hexdigest():
+            raise AbortRequest(400, "Bad Request - checksum mismatch, the file has been corrupted in transit.")
+
+    def format_line(self, filename):
+        """Format the checksum in the BSD style, that can be checked with sha256sum -c and b2sum -c"""
+        return "%s (%s) = %s" % (self.tag, filename, self.hexdigest())
+
+    def write_sidecar(self, file_path):
+        """Write the checksum into <file_path>.<algorithm>, next to the uploaded file."""
+        with open(file_path + "." + self.algorithm, "w") as fout:
+            fout.write(self.format_line(os.path.basename(file_path)) + "\n")
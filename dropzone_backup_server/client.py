@@ -0,0 +1,206 @@
+"""Client for parallel range uploads.
+
+A file is uploaded in an upload session. It is split into parts, and the parts are uploaded at the same time over
+multiple connections, with PUT requests that have a Content-Range header. Parts that fail are retried.
+"""
+import os
+import time
+import threading
+import http.client
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from .const import MB
+from .tokens import TOKEN_HEADER, TOKEN_SCHEME, EXPIRES_HEADER
+
+CHUNK_SIZE = 256 * 1024  # Size of blocks read from the file and sent to the server
+TOKEN_REFRESH = 60  # Seconds before the expiry of the upload token when a new one is requested
+
+
+class UploadError(Exception):
+    def __init__(self, status, message):
+        super().__init__("%s %s" % (status, message))
+        self.status = status
+        self.message = message
+
+
+def is_committed(body) -> bool:
+    """Tell if a response body means that the file has been committed. The "OK" may be followed by the checksum
+    of the file."""
+    return body.split("\n", 1)[0] == "OK"
+
+
+class RangeUploader(object):
+    def __init__(self, url, username=None, password=None, connections=4, part_size=64 * MB, retries=3,
+                 verbose=False):
+        """Create a new uploader.
+
+        :param url: Base url of the server, e.g. https://your.full.domain.name
+        :param connections: Number of parts uploaded at the same time.
+        :param part_size: Size of the parts the file is split into.
+        :param retries: Number of times a failed part is uploaded again.
+        """
+        self.url = urllib.parse.urlsplit(url)
+        self.base_path = self.url.path.rstrip("/")
+        self.username = username
+        self.password = password
+        self.connections = connections
+        self.part_size = part_size
+        self.retries = retries
+        self.verbose = verbose
+        self._local = threading.local()
+        self._token_lock = threading.Lock()
+        self._token = None
+        self._token_expires = 0
+        self._use_token = True  # Cleared when the server does not issue tokens
+
+    def _connect(self):
+        if self.url.scheme == "https":
+            return http.client.HTTPSConnection(self.url.netloc)
+        else:
+            return http.client.HTTPConnection(self.url.netloc)
+
+    def _get_connection(self):
+        """Get a connection for the current thread. Every thread keeps its connection alive."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def _get_token(self):
+        """Get an upload token, so that the password is verified by the server only once. Returns None when the
+        server does not issue tokens."""
+        with self._token_lock:
+            if self._use_token and self._token_expires - TOKEN_REFRESH < time.time():
+                conn = self._connect()
+                try:
+                    conn.request("POST", self.base_path + "/token", body=b"",
+                                 headers={"Username": self.username, "Password": self.password})
+                    response = conn.getresponse()
+                    body = response.read().decode("UTF-8", "replace")
+                finally:
+                    conn.close()
+                if response.status == 200:
+                    self._token, self._token_expires = body.strip(), int(response.getheader(EXPIRES_HEADER))
+                elif response.status in (404, 405):
+                    self._use_token = False
+                else:
+                    raise UploadError(response.status, body)
+            return self._token if self._use_token else None
+
+    def _headers(self, headers):
+        if self.username:
+            token = self._get_token()
+            if token:
+                headers[TOKEN_HEADER] = "%s %s" % (TOKEN_SCHEME, token)
+            else:
+                headers["Username"] = self.username
+                headers["Password"] = self.password
+        return headers
+
+    def _request(self, method, path, headers, body=None):
+        conn = self._get_connection()
+        try:
+            conn.request(method, self.base_path + path, body=body, headers=self._headers(headers))
+            response = conn.getresponse()
+            return response, response.read().decode("UTF-8", "replace")
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            self._local.conn = None
+            raise
+
+    def create_session(self, filename, length) -> str:
+        response, body = self._request("POST", "/sessions", {
+            "Upload-Filename": filename, "Upload-Length": str(length)})
+        if response.status != 201:
+            raise UploadError(response.status, body)
+        return body.strip()
+
+    def get_missing_ranges(self, session_id, length):
+        """Get the ranges that have not been written."""
+        response, body = self._request("HEAD", "/sessions/" + session_id, {})
+        if response.status == 404:
+            # The server does not tell if the file has been committed by a request whose response was lost, or the
+            # session has expired. Files cannot be read back, so the upload cannot be verified.
+            raise UploadError(response.status, "Upload session %s does not exist anymore." % session_id)
+        if response.status != 200:
+            raise UploadError(response.status, body)
+        missing, pos = [], 0
+        ranges = response.getheader("Upload-Ranges", "")
+        for item in filter(None, ranges.split(",")):
+            start, end = [int(value) for value in item.split("-")]
+            if start > pos:
+                missing.append((pos, start))
+            pos = end + 1
+        if pos < length:
+            missing.append((pos, length))
+        return missing
+
+    def upload_range(self, session_id, file_path, start, end) -> bool:
+        """Upload the [start, end) range of a file. Returns True when the upload has been completed."""
+        conn = self._get_connection()
+        try:
+            conn.putrequest("PUT", self.base_path + "/sessions/" + session_id)
+            headers = self._headers({
+                "Content-Range": "bytes %d-%d/%d" % (start, end - 1, os.path.getsize(file_path)),
+                "Content-Length": str(end - start),
+            })
+            for name, value in headers.items():
+                conn.putheader(name, value)
+            conn.endheaders()
+            with open(file_path, "rb") as fin:
+                fin.seek(start)
+                remaining = end - start
+                while remaining:
+                    data = fin.read(min(CHUNK_SIZE, remaining))
+                    if not data:
+                        raise UploadError(0, "File has been truncated while uploading.")
+                    conn.send(data)
+                    remaining -= len(data)
+            response = conn.getresponse()
+            body = response.read().decode("UTF-8", "replace")
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            self._local.conn = None
+            raise
+        if response.status != 200:
+            raise UploadError(response.status, body)
+        return is_committed(body)
+
+    def _upload_part(self, session_id, file_path, start, end):
+        try:
+            completed = self.upload_range(session_id, file_path, start, end)
+            if self.verbose:
+                print("Uploaded bytes %d-%d" % (start, end - 1))
+            return completed
+        except (OSError, http.client.HTTPException, UploadError) as e:
+            print("Upload of bytes %d-%d failed: %s" % (start, end - 1, e))
+            return False
+
+    def upload(self, file_path, filename=None) -> float:
+        """Upload a file. Returns the elapsed time in seconds."""
+        started = time.monotonic()
+        length = os.path.getsize(file_path)
+        filename = filename or os.path.basename(file_path)
+        session_id = self.create_session(filename, length)
+        if self.verbose:
+            print("Created upload session %s" % session_id)
+        missing = [(0, length)] if length else []
+        with ThreadPoolExecutor(max_workers=self.connections) as executor:
+            for attempt in range(self.retries + 1):
+                if not missing:
+                    break
+                parts = [(pos, min(pos + self.part_size, end))
+                         for start, end in missing for pos in range(start, end, self.part_size)]
+                futures = [executor.submit(self._upload_part, session_id, file_path, start, end)
+                           for start, end in parts]
+                if any([future.result() for future in futures]):
+                    return time.monotonic() - started
+                missing = self.get_missing_ranges(session_id, length)
+        if missing:
+            raise UploadError(0, "Upload did not complete, session id: %s" % session_id)
+        # Nothing is missing, but no request has committed the file (e.g. an empty file). An empty PATCH does it.
+        response, body = self._request("PATCH", "/sessions/" + session_id, {"Upload-Offset": str(length)}, b"")
+        if response.status != 200 or not is_committed(body):
+            raise UploadError(response.status, body)
+        return time.monotonic() - started
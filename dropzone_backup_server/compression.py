@@ -0,0 +1,74 @@
+"""On-the-fly compression of uploaded files.
+
+Uploads of users with the compress option (e.g. W;compress=zstd) are compressed by the server while they are
+written, and the stored file gets the extension of the format, so it can be decompressed with the usual tools. The
+data is compressed by the disk writer threads. zlib and zstandard release the GIL while compressing, so compression
+runs on the spare CPU cores, not on the IOLoop.
+
+zstd compression needs the optional zstandard package (pip install zstandard), gzip is always available.
+"""
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from . import metrics
+from .error import AbortRequest
+
+COMPRESSION_EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def parse_compression(value) -> str:
+    """Parse the compress option of a user. Returns an empty string for no compression."""
+    value = value.strip().lower()
+    if value in ("", "none"):
+        return ""
+    if value not in COMPRESSION_EXTENSIONS:
+        raise ValueError("invalid compression '%s'" % value)
+    return value
+
+
+def get_compressed_name(filename, compression):
+    """Get the name of the stored file, with the extension of the compression (if any)."""
+    return filename + COMPRESSION_EXTENSIONS[compression] if compression else filename
+
+
+class StreamCompressor(object):
+    """Compresses the data of an uploaded file. Called from the writer thread of the part."""
+
+    def __init__(self, compression, username):
+        if compression == "zstd":
+            if zstandard is None:
+                raise AbortRequest(500, "Server misconfiguration - zstd compression needs the zstandard package.")
+            self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        else:
+            # wbits=31 writes a gzip header. It contains no file name and no timestamp, so the same data is always
+            # compressed into the same file, and it can be deduplicated.
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        self.input_bytes = metrics.COMPRESSION_INPUT_BYTES.labels(username, compression)
+        self.output_bytes = metrics.COMPRESSION_OUTPUT_BYTES.labels(username, compression)
+        self.cpu_seconds = metrics.COMPRESSION_CPU_SECONDS.labels(username, compression)
+
+    def compress(self, buffers) -> list:
+        """Compress data, and return the compressed buffers that are ready to be written."""
+        started = time.thread_time()
+        result = [self._compressor.compress(data) for data in buffers]
+        self._observe(buffers, result, started)
+        return [data for data in result if data]
+
+    def flush(self) -> bytes:
+        """Finish the compressed stream, and return the rest of the data."""
+        started = time.thread_time()
+        data = self._compressor.flush()
+        self._observe([], [data], started)
+        return data
+
+    def _observe(self, buffers, result, started):
+        self.cpu_seconds.inc(time.thread_time() - started)
+        self.input_bytes.inc(sum(len(data) for data in buffers))
+        self.output_bytes.inc(sum(len(data) for data in result))
@@ -0,0 +1,165 @@
+"""Content addressed store for deduplicating uploaded files.
+
+Every distinct content is stored once, as a blob named after its SHA-256 hash. Uploaded files are hard links to
+the blobs, so a file that has been uploaded before takes no additional disk space. The number of links of a blob
+is its reference count: when it drops to one, no uploaded file refers to the blob, and it can be deleted.
+
+The blobs are the source of truth, the SQLite index only records the size and the dedup statistics of each blob.
+Hard links cannot cross file systems, so files uploaded to other file systems are stored normally. Since the
+files share the inode of their blob, they are made read-only.
+"""
+import os
+import time
+import stat
+import errno
+import sqlite3
+import threading
+
+from .staging import commit_file
+
+DEDUP_ALGORITHM = "sha256"
+
+# Errors of os.link() meaning that the file cannot be deduplicated, and should be stored normally.
+LINK_NOT_POSSIBLE = (errno.EXDEV, errno.EMLINK, errno.EPERM, errno.ENOTSUP)
+
+
+class DedupStore(object):
+    def __init__(self, path):
+        """Open a dedup store, create it when it does not exist.
+
+        :param path: Directory of the store. It should be on the same file system as the upload directories.
+        """
+        self.path = path
+        self.blob_dir = os.path.join(path, "blobs")
+        self.index_path = os.path.join(path, "index.sqlite")
+        self._local = threading.local()
+        os.makedirs(self.blob_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS blobs ("
+                         "hash TEXT PRIMARY KEY, size INTEGER NOT NULL, created REAL NOT NULL, "
+                         "hits INTEGER NOT NULL DEFAULT 0, saved INTEGER NOT NULL DEFAULT 0)")
+
+    def _connect(self) -> sqlite3.Connection:
+        """Get the connection of the current thread. Connections cannot be shared between threads."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.index_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def get_blob_path(self, content_hash):
+        return os.path.join(self.blob_dir, content_hash[:2], content_hash)
+
+    def store(self, src_path, final_path, content_hash, replace=True) -> bool:
+        """Move a file to its final location. When the same content has been stored before, the file is replaced
+        with a hard link to the existing blob. Otherwise the file becomes the blob of its content.
+
+        Called from writer threads.
+
+        :param src_path: The uploaded file, on the same file system as final_path.
+        :param final_path: Final location of the file.
+        :param content_hash: Hex digest of the content, computed with DEDUP_ALGORITHM.
+        :param replace: Replace an existing file. Otherwise FileExistsError is raised when the final path exists.
+        :return: True when the file has been deduplicated.
+        """
+        blob_path = self.get_blob_path(content_hash)
+        size = os.stat(src_path).st_size
+        for _ in range(3):
+            try:
+                if os.stat(blob_path).st_size != size:
+                    break  # Should never happen, but never link to a different content.
+                if replace:
+                    self._link_replace(blob_path, final_path)
+                else:
+                    os.link(blob_path, final_path)
+            except FileNotFoundError:
+                pass  # New content, or the blob has just been deleted by the garbage collector.
+            except OSError as e:
+                if e.errno in LINK_NOT_POSSIBLE:
+                    break
+                raise
+            else:
+                os.unlink(src_path)
+                self._record(content_hash, size, hit=True)
+                return True
+            os.chmod(src_path, stat.S_IMODE(os.stat(src_path).st_mode) & ~0o222)
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            try:
+                os.link(src_path, blob_path)
+            except FileExistsError:
+                continue  # Stored by another upload in the meantime, link to that one.
+            except OSError as e:
+                if e.errno in LINK_NOT_POSSIBLE:
+                    break
+                raise
+            try:
+                commit_file(src_path, final_path, replace)
+            except FileExistsError:
+                os.unlink(blob_path)
+                raise
+            self._record(content_hash, size, hit=False)
+            return False
+        commit_file(src_path, final_path, replace)
+        return False
+
+    @staticmethod
+    def _link_replace(blob_path, final_path):
+        """Atomically replace final_path with a hard link to blob_path."""
+        tmp_path = "%s.%d-%d.~link" % (final_path, os.getpid(), threading.get_ident())
+        os.link(blob_path, tmp_path)
+        try:
+            os.replace(tmp_path, final_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        try:
+            # rename() does nothing when final_path is already a link to the blob.
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+
+    def _record(self, content_hash, size, hit):
+        with self._connect() as conn:
+            conn.execute("INSERT INTO blobs (hash, size, created, hits, saved) VALUES (?, ?, ?, ?, ?) "
+                         "ON CONFLICT (hash) DO UPDATE SET hits = hits + excluded.hits, saved = saved + excluded.saved",
+                         (content_hash, size, time.time(), int(hit), size if hit else 0))
+
+    def collect_garbage(self) -> dict:
+        """Delete the blobs that are not referenced by uploaded files anymore, and bring the index up to date.
+
+        :return: Statistics of the store.
+        """
+        result = {"blobs": 0, "files": 0, "stored_bytes": 0, "saved_bytes": 0,
+                  "deleted_blobs": 0, "freed_bytes": 0, "total_saved_bytes": 0}
+        found = {}
+        for subdir in sorted(os.listdir(self.blob_dir)):
+            subdir_path = os.path.join(self.blob_dir, subdir)
+            if not os.path.isdir(subdir_path):
+                continue
+            for name in os.listdir(subdir_path):
+                blob_path = os.path.join(subdir_path, name)
+                try:
+                    st = os.stat(blob_path)
+                    if st.st_nlink <= 1:
+                        os.unlink(blob_path)
+                        result["deleted_blobs"] += 1
+                        result["freed_bytes"] += st.st_size
+                        continue
+                except FileNotFoundError:
+                    continue
+                found[name] = st.st_size
+                result["blobs"] += 1
+                result["files"] += st.st_nlink - 1
+                result["stored_bytes"] += st.st_size
+                result["saved_bytes"] += st.st_size * (st.st_nlink - 2)
+        with self._connect() as conn:
+            indexed = set(row[0] for row in conn.execute("SELECT hash FROM blobs"))
+            # Blobs stored while collecting are not in found, so check them again before removing.
+            removed = [(content_hash,) for content_hash in indexed - set(found)
+                       if not os.path.exists(self.get_blob_path(content_hash))]
+            conn.executemany("DELETE FROM blobs WHERE hash = ?", removed)
+            conn.executemany("INSERT INTO blobs (hash, size, created) VALUES (?, ?, ?)",
+                             [(content_hash, size, time.time()) for content_hash, size in found.items()
+                              if content_hash not in indexed])
+            result["total_saved_bytes"] = conn.execute("SELECT COALESCE(SUM(saved), 0) FROM blobs").fetchone()[0]
+        return result
@@ -0,0 +1,114 @@
+"""Durability of uploaded files.
+
+An uploaded file is written into a temporary file and renamed to its final name. Without synchronization, a crash
+can leave a renamed but empty file behind. The durability levels are:
+
+* none - never sync, rely on the kernel to write the data eventually.
+* per-file - sync the temporary file before the rename, and the directory after it.
+* group - hand the commits over to a GroupCommitter thread. It takes all commits that are waiting, syncs their
+  files, renames them, syncs the directories, and only then reports them as committed. Concurrent uploads share
+  the directory syncs and the journal commits of the file system, so the cost grows slower than the number of
+  files.
+"""
+import os
+import time
+import threading
+from concurrent.futures import Future
+
+from .error import AbortRequest
+from .logs import log
+from .metrics import FSYNC_LATENCY, GROUP_COMMIT_FILES
+
+DURABILITY_LEVELS = ["none", "per-file", "group"]
+
+
+def sync_fds(fds, data_only=False):
+    """Flush open files to the disk, one by one. Only these files are flushed, not the other dirty data of their
+    file systems (like syncfs() would), so a big unrelated write does not slow down the commits.
+
+    :param data_only: Use fdatasync() where available. It skips metadata that is not needed to read the data back,
+        e.g. the modification time.
+    """
+    sync = os.fdatasync if data_only and hasattr(os, "fdatasync") else os.fsync
+    started = time.perf_counter()
+    for fd in fds:
+        sync(fd)
+    FSYNC_LATENCY.observe(time.perf_counter() - started)
+
+
+def sync_dirs(paths):
+    """Flush directory entries (e.g. the results of renames) to the disk."""
+    fds = []
+    try:
+        for path in paths:
+            fds.append(os.open(path, os.O_RDONLY))
+        sync_fds(fds)
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def fsync_file(fd):
+    started = time.perf_counter()
+    os.fsync(fd)
+    FSYNC_LATENCY.observe(time.perf_counter() - started)
+
+
+class GroupCommitter(threading.Thread):
+    """Background thread that commits uploaded files in batches. Must be started in the worker process."""
+
+    def __init__(self):
+        super().__init__(name="group-commit", daemon=True)
+        self._lock = threading.Lock()
+        self._pending = []
+        self._ready = threading.Event()
+
+    def submit(self, fd, fn) -> Future:
+        """Commit a file.
+
+        :param fd: File descriptor of the temporary file. It must stay open until the returned future is done.
+        :param fn: Called after the file has been synced. It should rename the file, and return the list of the
+            directories that it has changed.
+        :return: A future that is resolved when the changes of fn have been synced, too.
+        """
+        future = Future()
+        with self._lock:
+            self._pending.append((fd, fn, future))
+        self._ready.set()
+        return future
+
+    def run(self):
+        while True:
+            self._ready.wait()
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._ready.clear()
+            if batch:
+                self._commit(batch)
+
+    def _commit(self, batch):
+        GROUP_COMMIT_FILES.observe(len(batch))
+        try:
+            sync_fds([fd for fd, fn, future in batch], data_only=True)
+        except Exception as e:
+            for fd, fn, future in batch:
+                future.set_exception(e)
+            return
+        dirs, results = set(), []
+        for fd, fn, future in batch:
+            try:
+                dirs.update(fn())
+                results.append((future, None))
+            except Exception as e:
+                results.append((future, e))
+        try:
+            sync_dirs(dirs)
+        except Exception as e:
+            results = [(future, error or e) for future, error in results]
+        for future, error in results:
+            if error is None:
+                future.set_result(None)
+            else:
+                if not isinstance(error, AbortRequest):
+                    log.error("Group commit failed", exc_info=error)
+                future.set_exception(error)
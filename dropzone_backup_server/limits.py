@@ -0,0 +1,105 @@
+"""Per-user limits of concurrent uploads and upload bandwidth.
+
+The state of the limits is kept in shared memory that is allocated before the worker processes are forked, so the
+limits apply to the sum of the uploads of a user in all workers. Users are identified by a 64 bit hash of their
+name. The number of uploads is counted separately for every worker, so the counts of a worker that has crashed can
+be reset when it is restarted.
+"""
+import time
+import ctypes
+import hashlib
+import multiprocessing
+
+TABLE_SIZE = 4096  # Max. number of users with limits
+BURST_SECONDS = 1.0  # Tokens saved up by an idle user, in seconds of its max. rate
+
+
+def make_entry_type(workers):
+    class Entry(ctypes.Structure):
+        _fields_ = [
+            ("key", ctypes.c_uint64),  # Hash of the user name, zero for unused entries
+            ("uploads", ctypes.c_int32 * workers),  # Number of uploads in progress, by worker
+            ("tokens", ctypes.c_double),  # Bytes that can be received without waiting, negative when in debt
+            ("updated", ctypes.c_double),  # Time of the last update of tokens
+        ]
+
+    return Entry
+
+
+class UserLimiter(object):
+    def __init__(self, workers=1, size=TABLE_SIZE):
+        """Allocate the shared state. Must be called before forking the workers.
+
+        :param workers: Number of worker processes.
+        """
+        self.workers = workers
+        self.size = size
+        self.worker_id = 0  # Set by the worker process after forking
+        self._lock = multiprocessing.Lock()
+        self._table = multiprocessing.RawArray(make_entry_type(workers), size)
+        self._indexes = {}  # Cache of user name -> table index, local to the process
+
+    def _get_entry(self, username):
+        index = self._indexes.get(username, None)
+        if index is not None:
+            return self._table[index]
+        key = int.from_bytes(hashlib.blake2b(username.encode("UTF-8"), digest_size=8).digest(), "little") or 1
+        index = key % self.size
+        for _ in range(self.size):
+            entry = self._table[index]
+            if entry.key == key:
+                break
+            if entry.key == 0:
+                entry.key = key
+                break
+            index = (index + 1) % self.size
+        else:
+            return None  # Table is full, the user is not limited.
+        self._indexes[username] = index
+        return entry
+
+    def acquire(self, username, max_uploads) -> bool:
+        """Start an upload. Returns False when the user already has max_uploads uploads in progress."""
+        with self._lock:
+            entry = self._get_entry(username)
+            if entry is None:
+                return True
+            if sum(entry.uploads) >= max_uploads:
+                return False
+            entry.uploads[self.worker_id] += 1
+            return True
+
+    def release(self, username):
+        """Finish an upload started with acquire()."""
+        with self._lock:
+            entry = self._get_entry(username)
+            if entry is not None and entry.uploads[self.worker_id] > 0:
+                entry.uploads[self.worker_id] -= 1
+
+    def consume(self, username, size, max_rate) -> float:
+        """Take size bytes from the token bucket of the user.
+
+        :param max_rate: Max. bytes per second of the user.
+        :return: Number of seconds the caller should wait before receiving more data.
+        """
+        with self._lock:
+            entry = self._get_entry(username)
+            if entry is None:
+                return 0.0
+            now = time.monotonic()
+            if entry.updated:
+                tokens = min(max_rate * BURST_SECONDS, entry.tokens + (now - entry.updated) * max_rate)
+            else:
+                tokens = max_rate * BURST_SECONDS
+            tokens -= size
+            entry.tokens, entry.updated = tokens, now
+        if tokens < 0:
+            return -tokens / max_rate
+        return 0.0
+
+    def reset_worker(self, worker_id):
+        """Forget the uploads of a worker process that has exited."""
+        with self._lock:
+            for entry in self._table:
+                if entry.key:
+                    entry.uploads[worker_id] = 0
@@ -0,0 +1,118 @@
+"""Logging of the server.
+
+Log records are put into a queue by the threads that log them, and they are formatted and written by a background
+thread, so logging never blocks the IOLoop with formatting or file I/O. Every process has its own background thread,
+see setup_logging().
+
+Loggers:
+
+* dzbackup - diagnostics. Warnings and errors by default, informational messages with --verbose, and debug
+  messages with --debug.
+* dzbackup.access - one line per request, see log_request(). Can be turned off with --no-access-log.
+* dzbackup.trace - events of single chunks of uploads, sampled with --trace-sample-rate.
+"""
+import sys
+import json
+import queue
+import random
+import logging
+import logging.handlers
+
+from .const import MB
+
+log = logging.getLogger("dzbackup")
+access_log = logging.getLogger("dzbackup.access")
+trace_log = logging.getLogger("dzbackup.trace")
+
+LOG_FORMAT = "%(asctime)s [%(process)d] %(levelname)s %(name)s: %(message)s"
+
+_listener = None
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Puts records into the queue as they are. Unlike QueueHandler, it does not format the message in the thread
+    that logs it, so the arguments of log calls must not be changed after logging."""
+
+    def prepare(self, record):
+        return record
+
+
+class LogFields(object):
+    """Fields of a log line in the key=value format, formatted only when the line is written."""
+
+    def __init__(self, fields):
+        """:param fields: A list of (name, value) tuples."""
+        self.fields = fields
+
+    @staticmethod
+    def format_value(value):
+        if value is None:
+            return "-"
+        if isinstance(value, float):
+            return "%.3f" % value
+        value = str(value)
+        if not value or any(c in value for c in ' "=\\') or not value.isprintable():
+            return json.dumps(value)
+        return value
+
+    def __str__(self):
+        return " ".join("%s=%s" % (name, self.format_value(value)) for name, value in self.fields)
+
+
+def setup_logging(config):
+    """Send the log records of the process to a background thread, that writes them to the log file or stderr.
+
+    Threads are not inherited by forked processes, so it must be called again in the worker processes.
+    """
+    global _listener
+    _listener = None  # The thread of the parent process does not exist in a forked process.
+    if config.log_file:
+        # Reopens the file when it has been rotated, e.g. by logrotate.
+        handler = logging.handlers.WatchedFileHandler(config.log_file)
+    else:
+        handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_queue = queue.SimpleQueue()  # Can be used from signal handlers
+    logging.getLogger().handlers = [DeferredQueueHandler(log_queue)]
+    log.setLevel(logging.DEBUG if config.debug else logging.INFO if config.verbose else logging.WARNING)
+    access_log.setLevel(logging.INFO if config.access_log else logging.WARNING)
+    trace_log.setLevel(logging.DEBUG if config.trace_sample_rate else logging.WARNING)
+    _listener = logging.handlers.QueueListener(log_queue, handler)
+    _listener.start()
+
+
+def stop_logging():
+    """Write the records that are still in the queue, and stop the background thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def is_traced(sample_rate) -> bool:
+    """Tell if a trace event should be logged, see --trace-sample-rate."""
+    return sample_rate > 0 and random.random() < sample_rate
+
+
+def log_request(handler, status=None):
+    """Write the access log line of a request. This is the log_function of the tornado Application.
+
+    Handlers can add fields to the line with a get_log_fields() method, that returns a list of (name, value)
+    tuples. When they contain the number of bytes received ("bytes"), the throughput is added, too.
+
+    :param status: Status of the request, when it is not the status of the response (e.g. "aborted").
+    """
+    if not access_log.isEnabledFor(logging.INFO):
+        return
+    request = handler.request
+    duration = request.request_time()
+    fields = [("status", status or handler.get_status()), ("method", request.method), ("path", request.path),
+              ("ip", request.remote_ip)]
+    get_log_fields = getattr(handler, "get_log_fields", None)
+    if get_log_fields is not None:
+        fields += get_log_fields()
+    fields.append(("duration", duration))
+    received = dict(fields).get("bytes", None)
+    if received:
+        fields.append(("mb_per_s", received / MB / duration if duration > 0 else 0.0))
+    access_log.info("%s", LogFields(fields))
@@ -0,0 +1,186 @@
+"""Metrics of the server, exported in the Prometheus text format.
+
+Metrics are kept in the memory of the process. With multiple workers, every worker has its own metrics, labelled
+with the id of the worker (see the --metrics-port option). Updating a metric is cheap: label values are resolved
+once per request with labels(), and text is only formatted when the metrics are scraped. Hot paths should count
+bytes locally and add them to counters in batches.
+"""
+import bisect
+import threading
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+DURATION_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0, 14400.0)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels):
+    """Format a list of (name, value) tuples."""
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, escape(value)) for name, value in labels) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value)
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+        self.const_labels = {}  # Labels added to all metrics, e.g. the id of the worker process
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def format(self) -> str:
+        const_labels = sorted(self.const_labels.items())
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.documentation))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type_name))
+            metric.collect(lines, const_labels)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class CounterChild(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class HistogramChild(object):
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Non-cumulative, the last one is for +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Metric(object):
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _create_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """Get the child metric for the given label values. Keep the result if it is used many times."""
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key, None)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._create_child())
+        return child
+
+    def collect(self, lines, const_labels):
+        for key, child in sorted(self._children.items()):
+            self.collect_child(lines, const_labels + list(zip(self.labelnames, key)), child)
+
+    def collect_child(self, lines, labels, child):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def _create_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        """Increment a counter without labels."""
+        self.labels().inc(amount)
+
+    def collect_child(self, lines, labels, child):
+        lines.append("%s%s %s" % (self.name, format_labels(labels), format_value(child.value)))
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _create_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        """Observe a value of a histogram without labels."""
+        self.labels().observe(value)
+
+    def collect_child(self, lines, labels, child):
+        with child._lock:
+            counts, total = list(child.counts), child.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            lines.append("%s_bucket%s %d" % (self.name, format_labels(labels + [("le", format_value(bound))]),
+                                             cumulative))
+        lines.append("%s_sum%s %s" % (self.name, format_labels(labels), format_value(total)))
+        lines.append("%s_count%s %d" % (self.name, format_labels(labels), cumulative))
+
+
+class GaugeFunc(Metric):
+    """A gauge without labels, whose value is returned by a function when the metrics are scraped."""
+    type_name = "gauge"
+
+    def __init__(self, name, documentation, fn, registry=REGISTRY):
+        super().__init__(name, documentation, (), registry)
+        self.fn = fn
+
+    def collect(self, lines, const_labels):
+        lines.append("%s%s %s" % (self.name, format_labels(const_labels), format_value(self.fn())))
+
+
+RECEIVED_BYTES = Counter("dzbackup_received_bytes_total", "Bytes of uploaded data received.")
+USER_RECEIVED_BYTES = Counter("dzbackup_user_received_bytes_total",
+                              "Bytes of uploaded data received, by user.", ["user"])
+REQUEST_DURATION = Histogram("dzbackup_request_duration_seconds", "Duration of requests.",
+                             ["handler", "method"], buckets=DURATION_BUCKETS)
+ERRORS = Counter("dzbackup_errors_total", "Requests that failed with a 4xx or 5xx status.", ["status", "reason"])
+ABORTED_UPLOADS = Counter("dzbackup_aborted_uploads_total", "Uploads aborted because the client disconnected.")
+UPLOADED_FILES = Counter("dzbackup_uploaded_files_total", "Files moved to their final location.")
+AUTH_QUEUE_WAIT = Histogram("dzbackup_auth_queue_wait_seconds",
+                            "Time spent waiting for a free password verifier thread.")
+AUTH_VERIFY = Histogram("dzbackup_auth_verify_seconds", "Time spent verifying Argon2 password hashes.")
+WRITE_LATENCY = Histogram("dzbackup_write_seconds", "Latency of writes into temporary files.")
+RENAME_LATENCY = Histogram("dzbackup_rename_seconds", "Latency of moving uploaded files to their final location.")
+FSYNC_LATENCY = Histogram("dzbackup_fsync_seconds", "Latency of flushing uploaded files to the disk.")
+GROUP_COMMIT_FILES = Histogram("dzbackup_group_commit_files", "Number of files committed together by group commits.",
+                               buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+COMPRESSION_INPUT_BYTES = Counter("dzbackup_compression_input_bytes_total",
+                                  "Bytes of uploaded data compressed by the server, by user.", ["user", "algorithm"])
+COMPRESSION_OUTPUT_BYTES = Counter("dzbackup_compression_output_bytes_total",
+                                   "Bytes written by the compression of uploaded data, by user.", ["user", "algorithm"])
+COMPRESSION_CPU_SECONDS = Counter("dzbackup_compression_cpu_seconds_total",
+                                  "CPU time spent compressing uploaded data, by user.", ["user", "algorithm"])
@@ -0,0 +1,151 @@
+"""Streaming multipart/form-data parser that does not copy the uploaded data.
+
+The parser of tornadostreamform appends every chunk to a buffer and slices it, so every byte of the body is copied
+several times. This parser searches the boundaries in the received chunks with bytes.find, and passes memoryview
+slices of the chunks to the parts. Only a small window at the end of a chunk, that may contain the beginning of a
+boundary, is carried over to the next one.
+"""
+from tornadostreamform.multipart_streamer import MultiPartStreamer
+
+from .error import AbortRequest
+
+SEP = b"\r\n"
+HEADER_END = SEP + SEP
+FINAL_SUFFIX = b"--"
+
+MAX_DELIMITER_SIZE = 1000  # Same limit as in tornadostreamform
+MAX_HEADER_SIZE = 64 * 1024  # Max. size of the headers of a single part
+
+# Parser states
+PREAMBLE, HEADERS, DATA, DONE = range(4)
+
+
+class ZeroCopyMultiPartStreamer(MultiPartStreamer):
+    """Drop-in replacement of tornadostreamform's MultiPartStreamer, with the same part interface.
+
+    Parts receive memoryview objects that refer to the chunks received by the request handler, so they must not
+    modify them. A boundary is CRLF, the delimiter line (the first line of the body), and CRLF for the next part
+    or "--" for the end of the body. The epilogue after the last boundary is ignored.
+    """
+
+    def __init__(self, total):
+        super().__init__(total)
+        self.state = PREAMBLE
+        self.marker = None  # Beginning of the boundaries: CRLF and the delimiter line
+        self.tail = b""  # Data carried over to the next chunk
+
+    def data_received(self, chunk):
+        self.received += len(chunk)
+        self.on_progress(self.received, self.total)
+        pos = 0
+        if self.tail:
+            if self.state == DATA and len(chunk) > len(self.marker) + 1:
+                pos = self._receive_boundary_in_tail(chunk)
+            else:
+                # Short chunk or incomplete headers: a small copy.
+                chunk, self.tail = self.tail + chunk, b""
+        self._process(chunk, pos)
+
+    def data_complete(self):
+        if self.state == DATA:
+            # The final boundary is missing. Keep the data up to the last partial boundary, like tornadostreamform.
+            idx = self.tail.rfind(self.marker)
+            self._feed(self.tail, 0, idx if idx >= 0 else len(self.tail))
+            self.tail = b""
+            self._end_part()
+            self.state = DONE
+
+    def _parse_header(self, header):
+        try:
+            return super()._parse_header(header)
+        except UnicodeDecodeError:
+            raise AbortRequest(400, "Bad Request - invalid multipart header encoding.")
+
+    def _feed(self, buf, start, end):
+        if start == 0 and end == len(buf):
+            self._feed_part(buf)
+        elif end > start:
+            self._feed_part(memoryview(buf)[start:end])
+
+    def _receive_boundary_in_tail(self, chunk):
+        """Find a boundary that starts in the tail and ends in the chunk.
+
+        :return: The position in the chunk where processing should continue.
+        """
+        tail, marker, mlen = self.tail, self.marker, len(self.marker)
+        self.tail = b""
+        window = tail + chunk[:mlen + 1]
+        search = 0
+        while True:
+            idx = window.find(marker, search)
+            if idx < 0 or idx >= len(tail):
+                self._feed(tail, 0, len(tail))
+                return 0
+            suffix = window[idx + mlen:idx + mlen + 2]
+            if suffix == SEP or suffix == FINAL_SUFFIX:
+                self._feed(tail, 0, idx)
+                self._end_part()
+                self.state = HEADERS if suffix == SEP else DONE
+                return idx + mlen + 2 - len(tail)
+            search = idx + 1
+
+    def _process(self, buf, pos):
+        end = len(buf)
+        while pos < end:
+            if self.state == DATA:
+                pos = self._process_data(buf, pos)
+            elif self.state == HEADERS:
+                if end - pos < len(SEP):
+                    self.tail = buf[pos:]
+                    return
+                headers = []
+                if buf.startswith(SEP, pos):
+                    pos += len(SEP)
+                else:
+                    idx = buf.find(HEADER_END, pos)
+                    if idx < 0:
+                        if end - pos > MAX_HEADER_SIZE:
+                            raise AbortRequest(400, "Bad Request - multipart headers are too long.")
+                        self.tail = buf[pos:]
+                        return
+                    headers = [self._parse_header(line) for line in buf[pos:idx].split(SEP)]
+                    pos = idx + len(HEADER_END)
+                self._begin_part(headers)
+                self.state = DATA
+            elif self.state == PREAMBLE:
+                idx = buf.find(SEP, pos)
+                if idx < 0:
+                    if end - pos > MAX_DELIMITER_SIZE:
+                        raise AbortRequest(400, "Bad Request - cannot find multipart delimiter.")
+                    self.tail = buf[pos:]
+                    return
+                self.delimiter = buf[pos:idx] + SEP
+                self.dlen = len(self.delimiter)
+                self.marker = SEP + buf[pos:idx]
+                pos = idx + len(SEP)
+                self.state = HEADERS
+            else:
+                return  # Epilogue
+
+    def _process_data(self, buf, pos):
+        """Feed data to the current part until the next boundary.
+
+        :return: The position after the boundary, or the end of the buffer.
+        """
+        marker, mlen, end = self.marker, len(self.marker), len(buf)
+        search = pos
+        while True:
+            idx = buf.find(marker, search)
+            if idx < 0 or idx + mlen + 2 > end:
+                # No complete boundary, keep the bytes that may be the beginning of one.
+                cut = idx if idx >= 0 else max(pos, end - mlen - 1)
+                self._feed(buf, pos, cut)
+                self.tail = buf[cut:]
+                return end
+            suffix = buf[idx + mlen:idx + mlen + 2]
+            if suffix == SEP or suffix == FINAL_SUFFIX:
+                self._feed(buf, pos, idx)
+                self._end_part()
+                self.state = HEADERS if suffix == SEP else DONE
+                return idx + mlen + 2
+            search = idx + 1  # The delimiter is followed by something else, so it is part of the data.
@@ -1,54 +1,169 @@
 import time
 import os
 import re
+import asyncio
+import hashlib
+import sqlite3
 import warnings
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from argon2 import PasswordHasher
 from argon2.exceptions import VerifyMismatchError
 
+from .const import *
 from .error import AbortRequest
+from .compression import parse_compression
+from .logs import log
 
 VALID_PERM_CODES = "W"
 
-HEADER = "# username:upload_dir_prefix:permission_flags:password_hash"
+HEADER = "# username:upload_dir_prefix:permission_flags[;option=value...]:password_hash"
 
+SIZE_SUFFIXES = {"K": 1024, "M": MB, "G": GB, "T": TB}
 
-class SecurityManager(object):
-    """Manages a list of users.
 
-    Can only be used from a single thread (async server).
+def parse_size(value) -> int:
+    """Parse a number of bytes with an optional K, M, G or T suffix, e.g. 10M"""
+    value = str(value).strip().upper()
+    if value and value[-1] in SIZE_SUFFIXES:
+        return int(float(value[:-1]) * SIZE_SUFFIXES[value[-1]])
+    return int(value)
 
-    DO NOT USE FROM MULTIPLE THREADS OR PROCESSES.
 
-    You can write into the passwd file on the disk, and it will be reloaded within the number of seconds defined in the
-    TTL value below. Otherwise all updates should be done through a security manager object, with this pattern:
+def format_size(size) -> str:
+    for suffix in "TGMK":
+        if size >= SIZE_SUFFIXES[suffix] and size % SIZE_SUFFIXES[suffix] == 0:
+            return "%d%s" % (size // SIZE_SUFFIXES[suffix], suffix)
+    return str(size)
+
+
+# Per-user options, stored after the permission flags. Name -> (parser, formatter)
+USER_OPTIONS = {
+    "max_uploads": (int, str),  # Max. number of concurrent uploads
+    "max_rate": (parse_size, format_size),  # Max. bytes per second, for all uploads of the user
+    "quota": (parse_size, format_size),  # Max. total size of the files in the upload directory of the user
+    "compress": (parse_compression, str),  # Compression of the uploaded files, see compression.py
+}
+
+
+def parse_perms(value):
+    """Parse the permission field of a passwd entry, e.g. W;max_uploads=4;max_rate=10M
+
+    :return: A tuple of (permission flags, options dict)
+    """
+    perms, *items = value.split(";")
+    options = {}
+    for item in items:
+        name, sep, option_value = item.partition("=")
+        name = name.strip()
+        if not sep or name not in USER_OPTIONS:
+            raise ValueError("invalid option '%s'" % item)
+        options[name] = USER_OPTIONS[name][0](option_value)
+    return perms.strip(), options
+
+
+def format_perms(perms, options):
+    return ";".join([perms] + ["%s=%s" % (name, USER_OPTIONS[name][1](options[name]))
+                               for name in sorted(options) if options[name]])
+
+# Result of an asynchronous password check. queue_wait and verify_time are given in seconds.
+AuthResult = namedtuple("AuthResult", ["ok", "queue_wait", "verify_time"])
+AUTH_FAILED = AuthResult(False, 0.0, 0.0)
+
+
+def get_upload_dir(upload_base_dir, prefix):
+    """Get the upload directory for a user prefix."""
+    if prefix.startswith(os.pardir):
+        return prefix
+    else:
+        return os.path.join(upload_base_dir, prefix)
+
+
+def get_upload_dirs(security_manager, upload_base_dir, anonymous_dir=None) -> set:
+    """Get the upload directories of all users, and the anonymous upload directory when given."""
+    prefixes = [user["prefix"] for user in security_manager.get_users().values()]
+    if anonymous_dir:
+        prefixes.append(anonymous_dir)
+    return set(get_upload_dir(upload_base_dir, prefix) for prefix in prefixes)
+
+
+class PasswordVerifier(object):
+    """Verifies Argon2 password hashes on a bounded thread pool, so that hashing never blocks the IOLoop.
+
+    The number of worker threads is the maximum number of concurrent verifications. Requests above that limit
+    wait in the queue of the executor.
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="argon2")
+
+    @staticmethod
+    def _verify(pwd_hash, password, queued_at) -> AuthResult:
+        started = time.monotonic()
+        try:
+            PasswordHasher().verify(pwd_hash, password)
+            ok = True
+        except VerifyMismatchError:
+            ok = False
+        return AuthResult(ok, started - queued_at, time.monotonic() - started)
+
+    async def verify(self, pwd_hash, password) -> AuthResult:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._verify, pwd_hash, password, time.monotonic())
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def check_login(login):
+    login = login.strip().lower()
+    if not re.match("[a-z][a-z0-9]*", login):
+        raise AbortRequest(400, "Invalid login name '%s'" % login)
+    return login
+
+
+def check_prefix(prefix):
+    prefix = prefix.strip()
+    if prefix and not (re.match("[a-z][a-z0-9]*(/[a-z][a-z0-9]*)*", prefix) and not prefix.endswith("/")):
+        raise AbortRequest(400, "Invalid prefix '%s'" % prefix)
+    return prefix
+
+
+def hash_password(password) -> str:
+    return PasswordHasher().hash(password)
+
 
+def hash_passwords(passwords, max_workers=None) -> list:
+    """Hash many passwords in parallel, on a process pool. Argon2 is slow on purpose, so this is used for bulk
+    imports of new users.
+    """
+    if len(passwords) < 2:
+        return [hash_password(password) for password in passwords]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(hash_password, passwords, chunksize=8))
+
+
+class TextUserStore(object):
+    """Users stored in a passwd text file, see HEADER for the format.
+
+    The whole file is parsed when it changes, and rewritten when users are saved or deleted, so this is meant for
+    a moderate number of users. Changes made to the file by other programs are seen within TTL seconds.
     """
     TTL = 10.0  # In seconds
 
-    def __init__(self, passwdfile):
-        self.passwdfile = passwdfile
+    def __init__(self, path):
+        self.path = path
         self._last_loaded = 0
         self._last_mtime = 0
-        self._users = None
         self._users = {}
         self._passwords = {}
 
-    def get_users(self) -> dict:
-        self._load_all()
-        return self._users
-
-    def get_user(self, login):
-        users = self.get_users()
-        if login in users:
-            return users[login]
-        else:
-            return None
-
     def _load_all(self):
         now = time.time()
         if self._last_loaded + self.TTL < now:
-            mtime = os.stat(self.passwdfile).st_mtime
+            mtime = os.stat(self.path).st_mtime
             if mtime != self._last_mtime:
                 self._load_users()
                 self._last_mtime = mtime
@@ -56,130 +171,322 @@ class SecurityManager(object):
 
     def _load_users(self):
         # TODO: check permissions of the passwd file and issue a warning when not protected.
-        print("Reloading users from %s" % self.passwdfile)
+        log.info("Reloading users from %s", self.path)
         self._users.clear()
         self._passwords.clear()
         lineno = 0
-        for line in open(self.passwdfile, "r"):
+        for line in open(self.path, "r"):
             lineno += 1
             line = line.strip()
             if line and not line.startswith("#"):
                 login, prefix, perms, *parts = line.split(":")
                 pwd = ":".join(parts)
-                login = login.strip().lower()
-                prefix = prefix.strip()
-                login_ok = re.match("[a-z][a-z0-9]*", login)
-                prefix_ok = not prefix or re.match(
-                    "[a-z][a-z0-9]*(/[a-z][a-z0-9]*)*", prefix) and not prefix.endswith("/")
-                if not login_ok:
-                    warnings.warn("WARNING: invalid login name '%s' at line %d" % (login, lineno))
-                if not prefix_ok:
-                    warnings.warn("WARNING: invalid prefix name '%s' at line %d" % (prefix, lineno))
-                if login_ok and prefix_ok:
-                    self._users[login] = {
-                        "name": login,
-                        "prefix": prefix,
-                        "perms": perms,
-                    }
-                    self._passwords[login] = pwd
+                try:
+                    perms, options = parse_perms(perms)
+                except ValueError as e:
+                    # Never load a user without the limits that were meant for it.
+                    warnings.warn("WARNING: %s at line %d, user is ignored" % (e, lineno))
+                    continue
+                try:
+                    login, prefix = check_login(login), check_prefix(prefix)
+                except AbortRequest as e:
+                    warnings.warn("WARNING: %s at line %d" % (e.message, lineno))
+                    continue
+                self._users[login] = {
+                    "name": login,
+                    "prefix": prefix,
+                    "perms": perms,
+                    "options": options,
+                }
+                self._passwords[login] = pwd
 
     def _dump_users(self):
-        print("Saving users to %s" % self.passwdfile)
-        usernames = sorted(self._users.keys())
-        with open(self.passwdfile + ".part", "w+") as fout:
+        log.info("Saving users to %s", self.path)
+        with open(self.path + ".part", "w+") as fout:
             fout.write(HEADER + "\n")
-            for username in usernames:
+            for username in sorted(self._users.keys()):
                 user = self._users[username]
-                # print("???",self._passwords)
-                # print("???",self._passwords[username])
-                line = "%s:%s:%s:%s" % (
-                    username,
-                    user["prefix"],
-                    user["perms"],
-                    self._passwords[username]
-                )
-                # print(repr(line))
-                fout.write(line + "\n")
-        bakfile = self.passwdfile + ".bak"
+                fout.write("%s:%s:%s:%s\n" % (
+                    username, user["prefix"], format_perms(user["perms"], user["options"]),
+                    self._passwords[username]))
+        bakfile = self.path + ".bak"
         if os.path.isfile(bakfile):
             os.unlink(bakfile)
-        os.rename(self.passwdfile, bakfile)
-        os.rename(fout.name, self.passwdfile)
+        if os.path.isfile(self.path):
+            os.rename(self.path, bakfile)
+        os.rename(fout.name, self.path)
+
+    def get_users(self) -> dict:
+        self._load_all()
+        return self._users
+
+    def get_user(self, login):
+        return self.get_users().get(login, None)
+
+    def get_password_hash(self, login):
+        self._load_all()
+        return self._passwords.get(login, None)
+
+    def save_users(self, entries):
+        """Add or update users.
+
+        :param entries: A list of (user, password_hash) tuples.
+        """
+        if os.path.isfile(self.path):
+            self._last_loaded = 0  # Make sure that we have a fresh db
+            self._load_all()
+        for user, password_hash in entries:
+            self._users[user["name"]] = user
+            self._passwords[user["name"]] = password_hash
+        self._dump_users()
+
+    def delete_user(self, login) -> bool:
+        self._last_loaded = 0
+        self._load_all()
+        if login not in self._users:
+            return False
+        del self._users[login]
+        del self._passwords[login]
+        self._dump_users()
+        return True
+
+
+class SqliteUserStore(object):
+    """Users stored in an SQLite database, indexed by name.
+
+    Users are looked up with a single query when needed, and saved or deleted one row at a time, so it scales to
+    many thousands of users, and changes are seen immediately. The connection is reopened after a fork.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._pid = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=30)
+            self._pid = os.getpid()
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS users ("
+                               "name TEXT PRIMARY KEY, prefix TEXT NOT NULL, perms TEXT NOT NULL, "
+                               "password TEXT NOT NULL)")
+        return self._conn
+
+    @staticmethod
+    def _make_user(name, prefix, perms):
+        """Create a user from a row, or return None when its options are invalid."""
+        try:
+            perms, options = parse_perms(perms)
+        except ValueError as e:
+            warnings.warn("WARNING: %s, user %s is ignored" % (e, name))
+            return None
+        return {
+            "name": name,
+            "prefix": prefix,
+            "perms": perms,
+            "options": options,
+        }
+
+    def get_users(self) -> dict:
+        users = {name: self._make_user(name, prefix, perms) for name, prefix, perms in
+                 self._connect().execute("SELECT name, prefix, perms FROM users ORDER BY name")}
+        return {name: user for name, user in users.items() if user is not None}
+
+    def get_user(self, login):
+        row = self._connect().execute("SELECT name, prefix, perms FROM users WHERE name = ?", (login,)).fetchone()
+        return self._make_user(*row) if row else None
+
+    def get_password_hash(self, login):
+        row = self._connect().execute("SELECT password FROM users WHERE name = ?", (login,)).fetchone()
+        return row[0] if row else None
+
+    def save_users(self, entries):
+        """Add or update users.
+
+        :param entries: A list of (user, password_hash) tuples.
+        """
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO users (name, prefix, perms, password) VALUES (?, ?, ?, ?)",
+                             [(user["name"], user["prefix"], format_perms(user["perms"], user["options"]),
+                               password_hash) for user, password_hash in entries])
+
+    def delete_user(self, login) -> bool:
+        with self._connect() as conn:
+            return conn.execute("DELETE FROM users WHERE name = ?", (login,)).rowcount > 0
+
+
+SQLITE_EXTENSIONS = (".sqlite", ".sqlite3", ".db")
+
+
+def open_user_store(path):
+    """Open the user store of a passwd file. Files with an SQLite extension are SQLite databases."""
+    if path.lower().endswith(SQLITE_EXTENSIONS):
+        return SqliteUserStore(path)
+    else:
+        return TextUserStore(path)
+
+
+class SecurityManager(object):
+    """Manages a list of users.
+
+    Can only be used from a single thread (async server).
+
+    DO NOT USE FROM MULTIPLE THREADS OR PROCESSES.
+
+    Users are stored in a passwd text file, or in an SQLite database when the passwdfile has an SQLite extension
+    (see open_user_store). You can write into the passwd text file on the disk, and it will be reloaded within
+    TextUserStore.TTL seconds. Otherwise all updates should be done through a security manager object.
+    """
+
+    def __init__(self, passwdfile):
+        self.passwdfile = passwdfile
+        self.store = open_user_store(passwdfile)
+
+    def get_users(self) -> dict:
+        return self.store.get_users()
+
+    def get_user(self, login):
+        return self.store.get_user(login)
+
+    def _get_password_hash(self, login):
+        """Return the password hash of an enabled user, or None."""
+        return self.store.get_password_hash(login) or None  # Null password -> disabled user
 
     def check_password(self, login, password) -> bool:
         if not password:
             return False
-        user = self.get_user(login)
-        if user:
-            if not self._passwords[login]:
-                return False  # Null password -> disable usedr
-            else:
-                try:
-                    PasswordHasher().verify(self._passwords[login], password)
-                    return True
-                except VerifyMismatchError:
-                    return False
+        pwd_hash = self._get_password_hash(login)
+        if pwd_hash:
+            try:
+                PasswordHasher().verify(pwd_hash, password)
+                return True
+            except VerifyMismatchError:
+                return False
         else:
             return False
 
+    async def check_password_async(self, login, password, verifier: PasswordVerifier) -> AuthResult:
+        """Same as check_password, but the hash is verified by the given verifier, off the IOLoop.
+
+        The user database is only accessed from the calling thread."""
+        if not password:
+            return AUTH_FAILED
+        pwd_hash = self._get_password_hash(login)
+        if pwd_hash:
+            return await verifier.verify(pwd_hash, password)
+        else:
+            return AUTH_FAILED
+
+    def get_fingerprint(self, login):
+        """Return a fingerprint of the passwd entry of an enabled user, or None. It changes whenever the password,
+        the prefix, the permissions or the options of the user change."""
+        pwd_hash = self._get_password_hash(login)
+        user = self.get_user(login) if pwd_hash else None
+        if user:
+            entry = "%s:%s:%s" % (user["prefix"], format_perms(user["perms"], user["options"]), pwd_hash)
+            return hashlib.blake2b(entry.encode("UTF-8"), digest_size=12).hexdigest()
+        else:
+            return None
+
     def get_perms(self, login) -> str:
-        users = self.get_users()
-        if login in users:
-            return users[login]["perms"]
+        user = self.get_user(login)
+        if user:
+            return user["perms"]
         else:
             return ""
 
-    def save_user(self, login, prefix, perms, password):
-        # Make sure that we have a fresh db
-        self.get_users()
-        # Validate parameters
-        login = login.strip().lower()
-        prefix = prefix.strip()
-        login_ok = re.match("[a-z][a-z0-9]*", login)
-        prefix_ok = not prefix or re.match(
-            "[a-z][a-z0-9]*(/[a-z][a-z0-9]*)*", prefix) and \
-                    not prefix.endswith("/")
-        if not login_ok:
-            raise AbortRequest(400, "Invalid login name '%s'" % login)
-        if not prefix_ok:
-            raise AbortRequest(400, "Invalid prefix '%s'" % prefix)
+    def _make_user(self, login, prefix, perms, options=None):
+        """Validate the parameters of save_user, and merge the options of an existing user.
 
+        :return: A tuple of (user, existing password hash or None)
+        """
+        login, prefix = check_login(login), check_prefix(prefix)
         perms = "".join([perm for perm in perms if perm in VALID_PERM_CODES])
-        if not password:
-            if login in self._passwords:
-                password = self._passwords[login]
-        else:
-            if password and len(password) < 6:
-                raise AbortRequest(403, "Minimum password length is 6.")
-            elif password == login:
-                raise AbortRequest(403, "Password and login must not match.")
-            password = PasswordHasher().hash(password)
-
-        if login_ok and prefix_ok:
-            # Save to memory
-            user = {
-                "name": login,
-                "prefix": prefix,
-                "perms": perms,
-            }
-            print("Saving user %s" % login)
-            self._users[login] = user
-            self._passwords[login] = password
-            self._dump_users()
+        existing = self.get_user(login)
+        merged_options = dict(existing["options"]) if existing else {}
+        for name, value in (options or {}).items():
+            if name not in USER_OPTIONS:
+                raise AbortRequest(400, "Invalid option '%s'" % name)
+            if value:
+                merged_options[name] = value
+            else:
+                merged_options.pop(name, None)
+        user = {
+            "name": login,
+            "prefix": prefix,
+            "perms": perms,
+            "options": merged_options,
+        }
+        return user, self.store.get_password_hash(login) if existing else None
+
+    @staticmethod
+    def _check_new_password(login, password):
+        if len(password) < 6:
+            raise AbortRequest(403, "Minimum password length is 6.")
+        elif password == login:
+            raise AbortRequest(403, "Password and login must not match.")
+
+    def save_user(self, login, prefix, perms, password, options=None):
+        """Add or update a user.
+
+        :param password: New password. When empty, the password of an existing user is kept.
+        :param options: Per-user options, see USER_OPTIONS. Options not given are kept for existing users. Zero
+            removes an option.
+        """
+        user, password_hash = self._make_user(login, prefix, perms, options)
+        if password:
+            self._check_new_password(user["name"], password)
+            password_hash = hash_password(password)
+        log.info("Saving user %s", user["name"])
+        self.store.save_users([(user, password_hash or "")])
+
+    def save_users(self, rows, max_workers=None):
+        """Add or update many users at once. Passwords are hashed in parallel, and the store is written once.
+
+        :param rows: A list of dicts with login, prefix, perms, password and options keys, like the parameters of
+            save_user().
+        :return: The number of users saved.
+        """
+        entries, passwords = [], []
+        for row in rows:
+            user, password_hash = self._make_user(row["login"], row.get("prefix", ""), row.get("perms", "W"),
+                                                  row.get("options", None))
+            password = row.get("password", None)
+            if password:
+                try:
+                    self._check_new_password(user["name"], password)
+                except AbortRequest as e:
+                    raise AbortRequest(e.status, "%s: %s" % (user["name"], e.message))
+            entries.append([user, password_hash or ""])
+            passwords.append(password)
+        new_passwords = [(index, password) for index, password in enumerate(passwords) if password]
+        hashes = hash_passwords([password for _, password in new_passwords], max_workers)
+        for (index, _), password_hash in zip(new_passwords, hashes):
+            entries[index][1] = password_hash
+        self.store.save_users([tuple(entry) for entry in entries])
+        return len(entries)
 
     def delete_user(self, login):
-        # Make sure that we have a fresh db
-        self.get_users()
-
-        # Validate parameters
-        login = login.strip().lower()
-        login_ok = re.match("[a-z][a-z0-9]*", login)
-        if not login_ok:
-            raise AbortRequest(400, "Invalid login name '%s'" % login)
-
-        if login in self._users:
-            print("Deleting user %s" % login)
-            del self._users[login]
-            self._dump_users()
+        login = check_login(login)
+        if self.store.delete_user(login):
+            log.info("Deleting user %s", login)
         else:
             raise AbortRequest(404, "Cannot delete, user does not exist.")
+
+    def import_users(self, passwdfile):
+        """Copy all users with their password hashes from another passwd file or database into this one.
+
+        :return: The number of users imported.
+        """
+        source = open_user_store(passwdfile)
+        entries = [(user, source.get_password_hash(name) or "") for name, user in source.get_users().items()]
+        self.store.save_users(entries)
+        return len(entries)
+
+    def export_users(self, passwdfile):
+        """Copy all users with their password hashes into another passwd file or database, e.g. a text file.
+
+        :return: The number of users exported.
+        """
+        return SecurityManager(passwdfile).import_users(self.passwdfile)
@@ -1,24 +1,46 @@
 #!/usr/bin/env python3
+import re
+import errno
+import asyncio
 import sys
+import time
 import signal
+import logging
 import threading
 import datetime
 import pytz
 
 from winpid import create_pid_file_or_exit
 
+from tornado import gen
 from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
 from tornado.web import RequestHandler, Application, StaticFileHandler, url, stream_request_body
 
-from tornadostreamform.multipart_streamer import MultiPartStreamer, TemporaryFileStreamedPart
+from tornadostreamform.multipart_streamer import StreamedPart, TemporaryFileStreamedPart
 
+from . import metrics
 from .const import *
 from .error import AbortRequest
-from .security import SecurityManager
+from .security import SecurityManager, PasswordVerifier, AuthResult, get_upload_dir, get_upload_dirs, format_size
+from .sessions import SESSION_DIR_NAME, UploadSession, SessionReaper, format_ranges
+from .writer import DiskWriter, pwrite_all, writev_all, preallocate
+from .multipart import ZeroCopyMultiPartStreamer
+from .limits import UserLimiter
+from .checksum import CHECKSUM_HEADER, StreamingChecksum, parse_checksum, update_from_file
+from .dedup import DEDUP_ALGORITHM, DedupStore
+from .usage import UsageIndex
+from .durability import GroupCommitter, fsync_file, sync_dirs
+from .tokens import TokenSigner, TOKEN_HEADER, TOKEN_SCHEME, EXPIRES_HEADER, load_secret
+from .staging import STAGING_DIR_NAME, StagingArea, commit_file
+from .compression import StreamCompressor, get_compressed_name
+from .logs import log, trace_log, setup_logging, stop_logging, is_traced, log_request
 
 MAX_BUFFER_SIZE = 4 * MB  # Max. size loaded into memory!
 MAX_BODY_SIZE = 4 * MB  # Max. size loaded into memory!
+METRICS_FLUSH_SIZE = 1 * MB  # Received bytes are added to the metrics in batches of this size
+ANONYMOUS_USER = "(anonymous)"  # User label of anonymous uploads in the metrics
 
 SIGNAL_NAMES = (dict((k.value, v) for v, k in reversed(sorted(signal.__dict__.items())) if
                      v.startswith('SIG') and not v.startswith('SIG_')))
@@ -32,6 +54,8 @@ class Config:
     max_file_size: int
     static_dir_path: str
     security_manager: SecurityManager
+    auth_workers: int
+    password_verifier: PasswordVerifier
     auto_remove_pid_file: bool
     pid_file_path: str
     listen_address: str
@@ -39,191 +63,1150 @@ class Config:
     auto_create_user_dir: bool
     verbose: bool
     debug: bool
+    workers: int
+    shutdown_timeout: float
+    writer_threads: int
+    write_queue_size: int
+    write_buffer_size: int
+    preallocate: bool
+    durability: str
+    group_committer: GroupCommitter
+    disk_writer: DiskWriter
+    staging: StagingArea
+    session_ttl: float
+    checksum: str
+    checksum_sidecar: bool
+    dedup_dir: str
+    dedup_store: DedupStore
+    metrics: bool
+    metrics_port: int
+    user_limiter: UserLimiter
+    usage_db: str
+    usage_index: UsageIndex
+    usage_scan_threads: int
+    token_ttl: float
+    token_secret_file: str
+    token_signer: TokenSigner
+    log_file: str
+    access_log: bool
+    trace_sample_rate: float
+
 
 def gen_timestamp_name():
     """Generate a name based on the current timestamp."""
     return datetime.datetime.now(pytz.UTC).isoformat()[:24].replace(":", "-").replace(".", "_")
 
 
-class DroppedFileStreamedPart(TemporaryFileStreamedPart):
-    def __init__(self, streamer, headers, upload_dir, config: Config):
+def check_filename(filename):
+    """Make sure that a client supplied file name cannot escape from the upload directory."""
+    if not filename or filename in (os.curdir, os.pardir, SESSION_DIR_NAME, STAGING_DIR_NAME) or "/" in filename \
+            or os.sep in filename or "\0" in filename:
+        raise AbortRequest(400, "Invalid file name.")
+    return filename
+
+
+def get_file_stat(file_path):
+    """Get the os.stat() of a file, or None when it does not exist."""
+    try:
+        return os.stat(file_path)
+    except FileNotFoundError:
+        return None
+
+
+def update_usage(config: Config, file_path, old_stat):
+    """Add the change of a file in an upload directory to the usage index.
+
+    :param old_stat: os.stat() of the file before it was changed, or None when it did not exist.
+    """
+    if config.usage_index is not None:
+        config.usage_index.replace_file(os.path.dirname(file_path), old_stat, get_file_stat(file_path))
+
+
+async def check_password(config: Config, username, password) -> AuthResult:
+    """Verify the password of a user off the IOLoop, and add the verification time to the metrics."""
+    auth = await config.security_manager.check_password_async(username, password, config.password_verifier)
+    if auth.verify_time:
+        metrics.AUTH_QUEUE_WAIT.observe(auth.queue_wait)
+        metrics.AUTH_VERIFY.observe(auth.verify_time)
+    log.debug("Password check for %s: queue wait %.1f ms, verify %.1f ms",
+              username, auth.queue_wait * 1000, auth.verify_time * 1000)
+    return auth
+
+
+def get_username(headers):
+    """Get the normalized value of the Username header, or None."""
+    username = headers.get("Username", None)
+    if username is not None:
+        username = username.strip().lower()
+    return username or None
+
+
+def check_final_path(final_path, config: Config):
+    """Reject an upload early, when its destination exists and overwrite is disabled.
+
+    This is only a shortcut, the commit of the file fails atomically when the destination has been created in the
+    meantime. Existing files are replaced by the commit when overwrite is enabled, so they are kept while uploading.
+    """
+    if not config.overwrite and os.path.lexists(final_path):
+        raise AbortRequest(409, "Conflict - file already exists.")
+
+
+class DedupFileStreamedPart(TemporaryFileStreamedPart):
+    """Base class of parts that are moved to their final location through the dedup store, when it is enabled.
+
+    Subclasses must set the config attribute, and call set_checksum() before data is fed into the part.
+    """
+    committed = None  # Future of the group commit of the part, see commit()
+
+    def set_checksum(self, checksum, compressed=False):
+        """Set the checksum of the part, and create the hash of its content for the dedup store.
+
+        :param compressed: The data is compressed before it is stored. The hashes are updated with the received
+            data, the dedup hash must be updated with the stored data by the subclass.
+        """
+        self.checksum = checksum
+        self.dedup_hash = None
+        self.hashes = [checksum] if checksum is not None else []
+        if self.config.dedup_store is not None:
+            if checksum is not None and checksum.algorithm == DEDUP_ALGORITHM and not compressed:
+                self.dedup_hash = checksum
+            else:
+                self.dedup_hash = StreamingChecksum(DEDUP_ALGORITHM)
+                if not compressed:
+                    self.hashes.append(self.dedup_hash)
+
+    def move(self, file_path):
+        """Move the finalized temporary file to its final location, with a single rename. Raises a 409 error when
+        the file exists and overwrite is disabled."""
+        if not self.is_finalized:
+            raise Exception("Cannot move temporary file: stream is not finalized yet.")
+        if self.is_moved:
+            raise Exception("Cannot move temporary file: it has already been moved.")
+        started = time.perf_counter()
+        old_stat = get_file_stat(file_path) if self.config.usage_index is not None else None
+        self.f_out.close()
         try:
-            if config.auto_create_user_dir:
-                if not os.path.isdir(upload_dir):
-                    os.makedirs(upload_dir)
-            super().__init__(streamer, headers, upload_dir, tmp_suffix=config.tmp_suffix)
+            if self.dedup_hash is None:
+                commit_file(self.f_out.name, file_path, replace=self.config.overwrite)
+                deduplicated = False
+            else:
+                deduplicated = self.config.dedup_store.store(self.f_out.name, file_path, self.dedup_hash.hexdigest(),
+                                                             replace=self.config.overwrite)
+        except FileExistsError:
+            raise AbortRequest(409, "Conflict - file already exists.")
+        self.is_moved = True
+        metrics.RENAME_LATENCY.observe(time.perf_counter() - started)
+        metrics.UPLOADED_FILES.inc()
+        update_usage(self.config, file_path, old_stat)
+        if deduplicated and log.isEnabledFor(logging.INFO):
+            log.info("Deduplicated %s (%d bytes)", file_path, os.stat(file_path).st_size)
+
+    def commit(self, file_path, after_move=None):
+        """Move the finalized temporary file to its final location, with the durability level of the config.
+        Called from a writer thread.
+
+        With group commits, this returns before the file is moved, and the committed attribute is set to a future
+        that is resolved when the file and the directory entry are on the disk.
+
+        :param after_move: Called after the file has been moved, e.g. to write the checksum sidecar.
+        """
+        def move():
+            self.move(file_path)
+            if after_move is not None:
+                after_move()
+            return [os.path.dirname(file_path)]
+
+        if self.config.durability == "group":
+            self.committed = self.config.group_committer.submit(self.f_out.fileno(), move)
+        elif self.config.durability == "per-file":
+            fsync_file(self.f_out.fileno())
+            sync_dirs(move())
+        else:
+            move()
+
+    def release_after_commit(self, release):
+        """Call release() from a writer thread, but not before the group commit of the part is done, because it
+        still uses the temporary file."""
+        if self.committed is None:
+            release()
+        else:
+            self.committed.add_done_callback(lambda future: release())
+
+    def write_sidecar(self, file_path):
+        """Write the checksum of the part next to the file, see StreamingChecksum.write_sidecar()"""
+        sidecar_path = file_path + "." + self.checksum.algorithm
+        old_stat = get_file_stat(sidecar_path)
+        self.checksum.write_sidecar(file_path)
+        update_usage(self.config, sidecar_path, old_stat)
+
+
+class DroppedFileStreamedPart(DedupFileStreamedPart):
+    def __init__(self, streamer, headers, upload_dir, config: Config, filename=None, checksum_header=None,
+                 size=None, exact_size=False, compression=None, username=None):
+        """Create a part that is streamed into a temporary file and moved to the upload dir when finalized.
+
+        File operations after the creation of the temporary file are executed by the write queue of the streamer.
+        Checksums of the data are computed by the same operations, so the file never has to be read back. Received
+        chunks are collected until write_buffer_size bytes are available, and written with a single system call.
+
+        :param filename: Name of the destination file. When not given, it is taken from the Content-Disposition
+            part header.
+        :param checksum_header: Checksum sent by the client. When not given, it is taken from the Upload-Checksum
+            part header.
+        :param size: Size of the data, or an upper limit of it when exact_size is False. When given, disk space
+            is preallocated for the temporary file.
+        :param compression: Compress the data with this algorithm, see compression.py. The checksum is computed
+            from the received data.
+        :param username: User of the upload, for the compression metrics.
+        """
+        StreamedPart.__init__(self, streamer, headers)
+        self.write_queue = streamer.write_queue
+        self.config = config
+        self.is_moved = False
+        self.is_finalized = False
+        self.is_released = False
+        self.buffers = []  # Received data that has not been submitted to the write queue yet
+        self.buffered = 0
+        self.written = 0  # Bytes written into the temporary file
+        self.preallocated = False  # The temporary file may be longer than the data, see _preallocate()
+        self.compressor = None
+        try:
+            # Created in the staging dir of the upload dir, see staging.py
+            self.f_out = config.staging.create_temp_file(upload_dir, config.tmp_suffix, config.auto_create_user_dir)
         except FileNotFoundError:
             raise AbortRequest(500, "Server misconfiguration - could not write to user's upload directory.")
         try:
-            if config.debug:
-                print("DroppedFileStreamedPart headers", headers)
+            log.debug("DroppedFileStreamedPart headers %s", headers)
             self.upload_dir = upload_dir
-            filename = self.get_filename()
+            if filename is None:
+                filename = self.get_filename()
             if filename is None:
                 filename = gen_timestamp_name()
-                if config.debug or config.verbose:
-                    print("Warning, filename param not sent in Content-Disposition, generating a filename from "
-                          "the current timestamp.")
-            if config.debug:
-                print("final_path, upload_dir=%s, filename=%s" % (repr(upload_dir), repr(filename)))
-            self.final_path = os.path.join(upload_dir, filename)
-            if os.path.isfile(self.final_path):
-                if config.overwrite:
-                    os.unlink(self.final_path)
-                else:
-                    raise AbortRequest(409, "Conflict - file already exists.")
+                log.info("Filename param not sent in Content-Disposition, generating a filename from the current "
+                         "timestamp.")
+            log.debug("final_path, upload_dir=%r, filename=%r", upload_dir, filename)
+            self.filename = filename
+            self.final_path = os.path.join(upload_dir, get_compressed_name(filename, compression))
+            check_final_path(self.final_path, config)
+            if compression:
+                self.compressor = StreamCompressor(compression, username)
+            if checksum_header is None:
+                checksum_header = self.get_header_value(CHECKSUM_HEADER)
+            self.set_checksum(StreamingChecksum.create(checksum_header, config.checksum),
+                              compressed=self.compressor is not None)
+            # The size of compressed data is not known.
+            if size and config.preallocate and self.compressor is None:
+                self.write_queue.submit(self._preallocate, size, exact_size)
         except:
             self.release()
             raise
 
+    def get_header_value(self, name):
+        """Get the value of a part header, or None."""
+        for header in self.headers:
+            if header.get("name", "").lower().strip() == name.lower():
+                return header.get("value", None)
+        return None
+
+    def _preallocate(self, size, exact_size):
+        # A failed posix_fallocate() may still have extended the file.
+        self.preallocated = True
+        try:
+            preallocate(self.f_out.fileno(), size)
+        except OSError as e:
+            if exact_size and e.errno in (errno.ENOSPC, errno.EDQUOT):
+                raise AbortRequest(507, "Insufficient Storage.")
+            # The size is only an upper limit, the data may still fit.
+
+    def feed(self, data):
+        self.buffers.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.config.write_buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Submit the collected data to the write queue."""
+        if self.buffers:
+            buffers, size = self.buffers, self.buffered
+            self.buffers, self.buffered = [], 0
+            self.write_queue.submit(self._write, buffers, size=size)
+
+    def _write(self, buffers):
+        for checksum in self.hashes:
+            for data in buffers:
+                checksum.update(data)
+        if self.compressor is not None:
+            buffers = self.compressor.compress(buffers)
+        self._store(buffers)
+
+    def _store(self, buffers):
+        """Write data into the temporary file. The buffered file object is bypassed, all data is written with
+        writev()."""
+        if self.compressor is not None and self.dedup_hash is not None:
+            for data in buffers:
+                self.dedup_hash.update(data)  # Hash of the stored data, see set_checksum()
+        writev_all(self.f_out.fileno(), buffers)
+        self.written += sum(len(data) for data in buffers)
+
     def finalize(self):
+        self.flush()
+        self.write_queue.submit(self._commit)
+
+    def _commit(self):
+        if self.compressor is not None:
+            self._store([self.compressor.flush()])
+        if self.preallocated:
+            self.f_out.truncate(self.written)
         super().finalize()
-        self.move(self.final_path)
+        if self.checksum is not None:
+            self.checksum.verify()
+        if self.checksum is not None and self.config.checksum_sidecar:
+            # The checksum is the one of the uncompressed file, so the sidecar is named after it, e.g. z.bin.sha256
+            # next to z.bin.gz, and it can be checked after decompressing the file.
+            self.commit(self.final_path, lambda: self.write_sidecar(os.path.join(self.upload_dir, self.filename)))
+        else:
+            self.commit(self.final_path)
+
+    def release(self):
+        if not self.is_released:
+            self.is_released = True
+            self.buffers, self.buffered = [], 0
+            self.write_queue.submit(self.release_after_commit, super().release, always=True)
 
 
-class DropFileStreamer(MultiPartStreamer):
-    def __init__(self, upload_dir, total, config):
+class DropFileStreamer(ZeroCopyMultiPartStreamer):
+    def __init__(self, upload_dir, total, config, compression=None, username=None):
         super().__init__(total)
         self.upload_dir = upload_dir
         self.config = config
+        self.compression = compression
+        self.username = username
+        self.write_queue = config.disk_writer.open_queue()
+        self.remaining = total  # Bytes of the body not received before the current chunk
+
+    def data_received(self, chunk):
+        self.remaining = self.total - self.received
+        super().data_received(chunk)
 
     def create_part(self, headers):
-        return DroppedFileStreamedPart(self, headers=headers, upload_dir=self.upload_dir, config=self.config)
+        # The rest of the body is an upper limit of the size of the part.
+        return DroppedFileStreamedPart(self, headers=headers, upload_dir=self.upload_dir, config=self.config,
+                                       size=self.remaining, compression=self.compression, username=self.username)
+
+    def release_parts(self):
+        self.write_queue.cancel()
+        super().release_parts()
+
+
+class RawFileStreamer:
+    """Streams the raw request body into a single file, without multipart/form-data parsing.
+
+    It has the same interface as DropFileStreamer, so it can be used by the same request handler. The part is
+    created before any data is received, so conflicts are detected before the body is read.
+    """
+
+    def __init__(self, upload_dir, filename, total, config, checksum_header=None, compression=None, username=None):
+        self.total = total
+        self.received = 0
+        self.write_queue = config.disk_writer.open_queue()
+        self.part = DroppedFileStreamedPart(self, headers=[], upload_dir=upload_dir, config=config,
+                                            filename=filename, checksum_header=checksum_header, size=total,
+                                            exact_size=True, compression=compression, username=username)
+        self.parts = [self.part]
+
+    def data_received(self, chunk):
+        self.received += len(chunk)
+        # noinspection PyProtectedMember
+        self.part._size += len(chunk)
+        self.part.feed(chunk)
+
+    def data_complete(self):
+        self.part.finalize()
+
+    def release_parts(self):
+        self.write_queue.cancel()
+        [part.release() for part in self.parts]
+
+
+class SessionStreamedPart(DedupFileStreamedPart):
+    """Writes the request body into a byte range of the data file of an upload session.
+
+    The data file of the session is used as the temporary file, so unlike the base class, this does not create a
+    new one. The written range is saved into the session index when the request is finished, or when the client
+    disconnects. When all ranges of the session have been written, the data file is moved to its final location.
+    """
+
+    def __init__(self, streamer, session: UploadSession, start, config: Config):
+        StreamedPart.__init__(self, streamer, [])
+        self.write_queue = streamer.write_queue
+        self.session = session
+        self.config = config
+        self.is_moved = False
+        self.is_finalized = False
+        self.is_released = False
+        self.start = start  # Start of the range that has not been saved into the index yet
+        self.written = 0  # Bytes written since the last checkpoint
+        self.set_checksum(None)
+        self.f_out = open(session.data_path, "r+b", buffering=0)
+
+    def feed(self, data):
+        self.write_queue.submit(self._write, data, size=len(data))
+
+    def _write(self, data):
+        pwrite_all(self.f_out.fileno(), data, self.start + self.written)
+        self.written += len(data)
+
+    def finalize(self):
+        self.write_queue.submit(self._checkpoint)
+
+    def _save_range(self) -> bool:
+        """Save the written range into the index, and release the session, because this request does not write it
+        anymore.
+
+        The decision is made under the index lock, so of the requests finishing at the same time, the one saving
+        last does not see the shared locks of the others: it gets the exclusive lock, and must commit the session.
+
+        :return: True when all ranges have been written, and the session is locked exclusively by this request.
+        """
+        with self.session.index_lock():
+            self.session.reload()
+            self.session.add_range(self.start, self.start + self.written)
+            self.session.save()
+            self.start += self.written
+            self.written = 0
+            if self.session.is_complete and self.session.lock_exclusive():
+                return True
+            self.session.unlock()
+            return False
+
+    def _checkpoint(self):
+        if self._save_range():
+            self._commit_session()
+        # When other requests are still writing the session, the last one of them will commit it.
+
+    def _commit_session(self):
+        super().finalize()
+        # Ranges may arrive in any order, so checksums can only be computed from the file.
+        self.set_checksum(StreamingChecksum.create(self.session.checksum, self.config.checksum))
+        if self.hashes:
+            update_from_file(self.session.data_path, self.hashes)
+        if self.checksum is not None:
+            try:
+                self.checksum.verify()
+            except AbortRequest:
+                self.session.delete()
+                raise
+        self.commit(self.session.final_path, self._after_move)
+
+    def _after_move(self):
+        self.session.delete()
+        if self.checksum is not None and self.config.checksum_sidecar:
+            self.write_sidecar(self.session.final_path)
+
+    def release(self):
+        if not self.is_released:
+            self.is_released = True
+            self.write_queue.submit(self.release_after_commit, self._release, always=True)
+
+    def _release(self):
+        try:
+            # The request was aborted before its checkpoint. It may have been the last one holding a complete
+            # session, so it must commit it, even if nobody waits for the response.
+            if not self.is_finalized and self.session.is_locked and self._save_range():
+                self._commit_session()
+        finally:
+            self.f_out.close()
+            self.session.unlock()
+
+
+class SessionStreamer(RawFileStreamer):
+    """Streams the request body into the [start, end) range of an upload session."""
+
+    def __init__(self, session: UploadSession, start, end, total, config):
+        self.total = total
+        self.received = 0
+        self.session = session
+        self.start = start
+        self.end = end
+        self.write_queue = config.disk_writer.open_queue()
+        self.part = SessionStreamedPart(self, session, start, config)
+        self.parts = [self.part]
+
+    def data_received(self, chunk):
+        if self.start + self.received + len(chunk) > self.end:
+            raise AbortRequest(413, "Request Entity Too Large - data exceeds the upload range.")
+        super().data_received(chunk)
 
 
 @stream_request_body
 class DropFileHandler(RequestHandler):
     ps: DropFileStreamer
     config: Config
+    allowed_methods = ["post", "put"]
+    metrics_name = "upload"  # Handler label of the request metrics
+    in_flight = 0  # Number of requests uploading data in their body, processed by this process
+    auth_queue_wait: float  # Seconds spent waiting for a free password verifier thread
+    auth_verify_time: float  # Seconds spent verifying the password hash
+    received: int  # Bytes of the request body received
+    received_flushed: int  # Bytes of the request body already added to the metrics
 
     def initialize(self, config: Config) -> None:
         self.config = config
+        self.auth_queue_wait = 0.0
+        self.auth_verify_time = 0.0
+        self.received = 0
+        self.received_flushed = 0
+        self.user_received_bytes = None
+        self.user = None
+        self.max_rate = 0
+        self.ps = None
+        self._counted = False
+        self._upload_slot = None  # Name of the user whose upload slot is held by this request
         super().initialize()
 
-    def get_dest_dir(self):
-        username = self.request.headers.get("Username", None)
+    def _enter(self):
+        DropFileHandler.in_flight += 1
+        self._counted = True
+
+    def _leave(self):
+        if self._counted:
+            DropFileHandler.in_flight -= 1
+            self._counted = False
+        if self._upload_slot is not None:
+            self.config.user_limiter.release(self._upload_slot)
+            self._upload_slot = None
+
+    def is_upload(self) -> bool:
+        """Tell if the request uploads data in its body, so that the limits of the user apply."""
+        return True
 
-        if username is not None:
-            username = username.strip().lower()
-            if not username:
-                username = None
+    def apply_user_limits(self):
+        """Take an upload slot of the user, and set the bandwidth limit of the request."""
+        if self.user is None:
+            return
+        options = self.user["options"]
+        max_uploads = options.get("max_uploads", 0)
+        if max_uploads:
+            if not self.config.user_limiter.acquire(self.user["name"], max_uploads):
+                raise AbortRequest(429, "Too Many Requests - max. %d uploads are allowed at the same time." %
+                                   max_uploads)
+            self._upload_slot = self.user["name"]
+        self.max_rate = options.get("max_rate", 0)
+
+    async def check_quota(self, dir_path, size):
+        """Reject an upload of size bytes when it would exceed the quota of the user."""
+        if self.user is None or self.config.usage_index is None:
+            return
+        quota = self.user["options"].get("quota", 0)
+        if quota:
+            # SQLite can block on the lock of the index, so it is not queried from the IOLoop thread.
+            used, _ = await IOLoop.current().run_in_executor(None, self.config.usage_index.get, dir_path)
+            if used + size > quota:
+                raise AbortRequest(507, "Insufficient Storage - the upload would exceed the quota of %s, %s is "
+                                        "used." % (format_size(quota), format_size(used)))
+
+    def get_compression(self):
+        """Get the compression of the uploaded files, see the compress option of the user."""
+        if self.user is None:
+            return None
+        return self.user["options"].get("compress", None)
+
+    def check_token(self):
+        """Get the user of the upload token sent in the Authorization header, or None when there is no token."""
+        scheme, _, token = self.request.headers.get(TOKEN_HEADER, "").partition(" ")
+        if scheme != TOKEN_SCHEME or self.config.token_signer is None:
+            return None
+        username, fingerprint = self.config.token_signer.verify(token.strip())
+        if fingerprint != self.config.security_manager.get_fingerprint(username):
+            raise AbortRequest(403, "Invalid or expired token.")  # The passwd entry has changed
+        return username
+
+    async def get_dest_dir(self):
+        username = self.check_token()
+        if username is None:
+            username = get_username(self.request.headers)
+            if username is not None:
+                auth = await check_password(self.config, username, self.request.headers.get("Password", None))
+                self.auth_queue_wait, self.auth_verify_time = auth.queue_wait, auth.verify_time
+                if not auth.ok:
+                    raise AbortRequest(403, "Invalid username or password.")
 
         if username is None:
             if not self.config.anonymous_dir:
                 raise AbortRequest(401, "Unauthorized - anonymous uploads are not allowed.")
             prefix = self.config.anonymous_dir
+            self.user_received_bytes = metrics.USER_RECEIVED_BYTES.labels(ANONYMOUS_USER)
         else:
-            password = self.request.headers.get("Password", None)
-            if not self.config.security_manager.check_password(username, password):
-                raise AbortRequest(403, "Invalid username or password.")
-
             user = self.config.security_manager.get_user(username)
             prefix = user["prefix"]
+            self.user = user
+            self.user_received_bytes = metrics.USER_RECEIVED_BYTES.labels(username)
 
-        if prefix.startswith(os.pardir):
-            return prefix
-        else:
-            return os.path.join(self.config.upload_base_dir, prefix)
+        return get_upload_dir(self.config.upload_base_dir, prefix)
 
-    def prepare(self):
-        if self.config.debug:
-            print(self.request.headers)
+    async def prepare(self):
+        if self.is_upload():
+            self._enter()  # Not session probes, they do not hold up a shutdown
+        log.debug("%s %s headers %s", self.request.method, self.request.path, self.request.headers)
 
         try:
-            if self.request.method.lower() not in ["post", "put"]:
-                raise AbortRequest(405, "Method Not Allowed - only PUT and POST methods are supported.")
+            if self.request.method.lower() not in self.allowed_methods:
+                methods = [method.upper() for method in self.allowed_methods]
+                raise AbortRequest(405, "Method Not Allowed - only %s methods are supported." % (
+                    " and ".join([", ".join(methods[:-1]), methods[-1]]) if len(methods) > 1 else methods[0]))
+
+            if "Content-Length" in self.request.headers:
+                total = get_int_header(self.request.headers, "Content-Length")
+            else:
+                total = 0  # Chunked transfer encoding, tornado enforces the max. body size while reading.
+            if total > self.config.max_file_size:
+                raise AbortRequest(413, "Request Entity Too Large.")
 
-            dir_path = self.get_dest_dir()
+            dir_path = await self.get_dest_dir()
+            if self.is_upload():
+                self.check_destination(dir_path)
+                await self.check_quota(dir_path, total)
+                self.apply_user_limits()
 
             self.request.connection.set_max_body_size(self.config.max_file_size)
-            try:
-                total = int(self.request.headers.get("Content-Length", "0"))
-            except KeyError:
-                total = 0  # For any well formed browser request, Content-Length should have a value.
-            self.ps = DropFileStreamer(dir_path, total, config=self.config)
+            self.ps = self.create_streamer(dir_path, total)
         except AbortRequest as e:
-            self.set_status(e.status)
-            self.set_header("Content-Type", "text/plain")
-            self.write(e.message)
-            if self.config.debug:
-                print(e)
-            self.finish()
+            log.debug("%s %s rejected: %s", self.request.method, self.request.path, e)
+            # The body has not been read. Tornado does not send "100 Continue" to clients waiting for it, and
+            # closes the connection instead of reading the body.
+            self.send_abort(e, close=True)
+
+    def check_destination(self, dir_path):
+        """Reject the upload before its body is read, when the name of the destination file is already known."""
+        pass
+
+    def send_abort(self, e: AbortRequest, close=False):
+        """Send an error response.
+
+        :param close: The request body has not been read completely, tell the client that the connection will be
+            closed.
+        """
+        self.set_status(e.status)
+        if close:
+            self.set_header("Connection", "close")
+        self.set_header("Content-Type", "text/plain")
+        self.write(e.message)
+        self.finish()
+
+    def create_streamer(self, dir_path, total):
+        return DropFileStreamer(dir_path, total, config=self.config, compression=self.get_compression(),
+                                username=self.user and self.user["name"])
 
     def data_received(self, chunk):
-        if self.config.debug:
-            sys.stdout.write("received %s\n" % len(chunk))
-            sys.stdout.flush()
+        self.received += len(chunk)
+        if is_traced(self.config.trace_sample_rate):
+            trace_log.debug("%s %s received %d bytes, %d in total", self.request.method, self.request.path,
+                            len(chunk), self.received)
+        if self.received - self.received_flushed >= METRICS_FLUSH_SIZE:
+            self.flush_metrics()
         try:
             self.ps.data_received(chunk)
+            # Stop reading from the connection while the disk writer is behind.
+            wait = self.ps.write_queue.wait_for_space()
+            if self.max_rate:
+                delay = self.config.user_limiter.consume(self.user["name"], len(chunk), self.max_rate)
+                if delay > 0:
+                    return self.throttle(delay, wait)
+            return wait
+        except AbortRequest as e:
+            self.ps.release_parts()
+            self.send_abort(e, close=True)
+
+    @staticmethod
+    async def throttle(delay, wait):
+        """Stop reading from the connection for delay seconds, and until the write queue has space."""
+        await gen.sleep(delay)
+        if wait is not None:
+            await wait
+
+    async def post(self, *args):
+        try:
+            self.ps.data_complete()
+            await self.ps.write_queue.join()
+            await self.wait_for_commits()
+            queue = self.ps.write_queue
+            log.info("%s %s: %d writes, avg. write latency %.2f ms, max. queue depth %d KB",
+                     self.request.method, self.request.path, queue.writes,
+                     queue.write_time * 1000 / max(queue.writes, 1), queue.max_queued_bytes // 1024)
+            self.add_header("Cache-Control", "no-store")
+            self.add_header("Pragma", "no-cache")
+            self.add_header("Expires", "0")
+            self.write_result()
+            self.finish()
         except AbortRequest as e:
+            self.send_abort(e)
+        finally:
+            self.ps.release_parts()
+
+    put = post
+
+    async def wait_for_commits(self):
+        """Wait until the group commits of the parts are done, so the response is sent when the files are safe."""
+        for part in self.ps.parts:
+            if part.committed is not None:
+                try:
+                    await asyncio.wrap_future(part.committed)
+                except AbortRequest:
+                    raise
+                except Exception as e:
+                    raise AbortRequest(500, "Server error - could not write the uploaded file.") from e
+
+    def get_log_fields(self):
+        """Fields of the access log line, see log_request()."""
+        fields = [("user", self.user and self.user["name"])]
+        if self.ps is not None:
+            fields.append(("files", ",".join(part.filename for part in self.ps.parts
+                                             if getattr(part, "filename", None)) or None))
+        fields.append(("bytes", self.received))
+        return fields
+
+    def write_result(self):
+        lines = ["OK"]
+        for part in self.ps.parts:
+            if part.checksum is not None:
+                lines.append(part.checksum.format_line(part.filename))
+        self.write("\n".join(lines))
+
+    def flush_metrics(self):
+        """Add the bytes received since the last call to the metrics."""
+        received = self.received - self.received_flushed
+        if received:
+            self.received_flushed = self.received
+            metrics.RECEIVED_BYTES.inc(received)
+            if self.user_received_bytes is not None:
+                self.user_received_bytes.inc(received)
+
+    def on_finish(self):
+        self._leave()
+        self.flush_metrics()
+        status = self.get_status()
+        if status >= 400:
+            metrics.ERRORS.labels(status, self._reason).inc()
+        metrics.REQUEST_DURATION.labels(self.metrics_name, self.request.method).observe(self.request.request_time())
+
+    def on_connection_close(self):
+        if self.ps is not None:
             self.ps.release_parts()
+            metrics.ABORTED_UPLOADS.inc()
+        if self._counted:
+            log_request(self, status="aborted")
+        self._leave()
+        self.flush_metrics()
+        super().on_connection_close()
+
 
-            self.set_status(e.status)
+@stream_request_body
+class RawDropFileHandler(DropFileHandler):
+    """Upload a single file with PUT /upload/<filename>, the request body is the file content."""
+    allowed_methods = ["put"]
+    metrics_name = "upload_raw"
+
+    def check_destination(self, dir_path):
+        filename = get_compressed_name(check_filename(self.path_args[0]), self.get_compression())
+        check_final_path(os.path.join(dir_path, filename), self.config)
+
+    def create_streamer(self, dir_path, total):
+        filename = check_filename(self.path_args[0])
+        return RawFileStreamer(dir_path, filename, total, config=self.config,
+                               checksum_header=self.request.headers.get(CHECKSUM_HEADER, None),
+                               compression=self.get_compression(), username=self.user and self.user["name"])
+
+
+def get_int_header(headers, name):
+    """Get the value of a header that must be a non-negative integer."""
+    value = headers.get(name, None)
+    if value is None:
+        raise AbortRequest(400, "Bad Request - %s header is required." % name)
+    try:
+        value = int(value)
+    except ValueError:
+        value = -1
+    if value < 0:
+        raise AbortRequest(400, "Bad Request - invalid %s header." % name)
+    return value
+
+
+PAT_CONTENT_RANGE = re.compile(r"^bytes\s+(\d+)-(\d+)/(\d+|\*)$")
+
+
+def get_content_range(headers, length):
+    """Parse the Content-Range header of a request, and return a [start, end) range."""
+    res = PAT_CONTENT_RANGE.match(headers.get("Content-Range", "").strip())
+    if not res:
+        raise AbortRequest(400, "Bad Request - a valid Content-Range header is required.")
+    start, end, total = res.groups()
+    start, end = int(start), int(end) + 1
+    if start >= end or end > length or (total != "*" and int(total) != length):
+        raise AbortRequest(416, "Range Not Satisfiable.")
+    return start, end
+
+
+@stream_request_body
+class SessionHandler(DropFileHandler):
+    """Resumable and parallel uploads.
+
+    * POST /sessions creates a new session. The Upload-Filename and Upload-Length headers give the name and the size
+      of the file. The id of the new session is returned in the response body.
+    * HEAD or GET /sessions/<session_id> returns the committed offset in the Upload-Offset header, and the ranges
+      that have been written in the Upload-Ranges header.
+    * PATCH /sessions/<session_id> appends the request body to the file. The Upload-Offset header must be equal
+      to the committed offset.
+    * PUT /sessions/<session_id> writes the range given in the Content-Range header. Different ranges can be
+      uploaded at the same time, over multiple connections.
+    * DELETE /sessions/<session_id> aborts the upload.
+
+    When all bytes have arrived, the file is moved to its final location.
+    """
+    allowed_methods = ["post", "head", "get", "patch", "put", "delete"]
+    metrics_name = "sessions"
+    upload_dir: str
+    session: UploadSession
+
+    def is_upload(self):
+        return self.request.method.lower() in ["patch", "put"]
+
+    def create_streamer(self, dir_path, total):
+        self.upload_dir = dir_path
+        session_id = self.path_args[0]
+        method = self.request.method.lower()
+        if (method == "post") != (session_id is None):
+            raise AbortRequest(405, "Method Not Allowed.")
+        if method not in ["patch", "put"]:
+            return None
+        self.session = UploadSession.load(dir_path, session_id)
+        self.session.lock(shared=method == "put")
+        try:
+            self.session.reload()
+            if method == "patch":
+                self.set_header("Upload-Offset", str(self.session.offset))
+                start, end = get_int_header(self.request.headers, "Upload-Offset"), self.session.length
+                if start != self.session.offset:
+                    raise AbortRequest(409, "Conflict - Upload-Offset does not match the committed offset.")
+            else:
+                start, end = get_content_range(self.request.headers, self.session.length)
+                if total != end - start:
+                    raise AbortRequest(400, "Bad Request - Content-Length does not match Content-Range.")
+            return SessionStreamer(self.session, start, end, total, config=self.config)
+        except:
+            self.session.unlock()
+            raise
+
+    def data_received(self, chunk):
+        if self.ps is None:
+            self.send_abort(AbortRequest(400, "Bad Request - unexpected request body."), close=True)
+        else:
+            return super().data_received(chunk)
+
+    async def post(self, session_id=None):
+        try:
+            filename = check_filename(self.request.headers.get("Upload-Filename", None))
+            length = get_int_header(self.request.headers, "Upload-Length")
+            if length > self.config.max_file_size:
+                raise AbortRequest(413, "Request Entity Too Large.")
+            await self.check_quota(self.upload_dir, length)
+            if not self.config.auto_create_user_dir and not os.path.isdir(self.upload_dir):
+                raise AbortRequest(500, "Server misconfiguration - could not write to user's upload directory.")
+            check_final_path(os.path.join(self.upload_dir, filename), self.config)
+            checksum = self.request.headers.get(CHECKSUM_HEADER, None)
+            if checksum:
+                parse_checksum(checksum)
+            self.session = session = UploadSession.create(self.upload_dir, filename, length, checksum)
+            queue = self.config.disk_writer.open_queue()
+            queue.submit(session.preallocate)
+            await queue.join()
+            self.set_status(201)
+            self.set_header("Location", "/sessions/" + session.session_id)
+            self.set_header("Upload-Offset", "0")
             self.set_header("Content-Type", "text/plain")
-            self.write(e.message)
+            self.write(session.session_id)
             self.finish()
+        except AbortRequest as e:
+            self.send_abort(e)
+
+    def head(self, session_id):
+        try:
+            session = UploadSession.load(self.upload_dir, session_id)
+            self.set_header("Cache-Control", "no-store")
+            self.set_header("Upload-Offset", str(session.offset))
+            self.set_header("Upload-Length", str(session.length))
+            self.set_header("Upload-Ranges", format_ranges(session.ranges))
+            if self.request.method == "GET":
+                self.set_header("Content-Type", "text/plain")
+                self.write(str(session.offset))
+            self.finish()
+        except AbortRequest as e:
+            self.send_abort(e)
+
+    get = head
 
-    def post(self):
+    patch = put = DropFileHandler.post
+
+    def delete(self, session_id):
         try:
+            session = UploadSession.load(self.upload_dir, session_id)
+            session.lock()
             try:
-                self.ps.data_complete()
-                self.add_header("Cache-Control", "no-store")
-                self.add_header("Pragma", "no-cache")
-                self.add_header("Expires", "0")
-                self.write("OK")
+                session.delete()
             finally:
-                self.ps.release_parts()
-        finally:
+                session.unlock()
+            self.write("OK")
             self.finish()
+        except AbortRequest as e:
+            self.send_abort(e)
 
-    put = post
+    def get_log_fields(self):
+        session = getattr(self, "session", None)
+        return [("user", self.user and self.user["name"]), ("session", session and session.session_id),
+                ("files", session and session.filename), ("bytes", self.received)]
+
+    def write_result(self):
+        self.set_header("Upload-Offset", str(self.session.offset))
+        self.set_header("Upload-Ranges", format_ranges(self.session.ranges))
+        if self.ps.part.is_moved:
+            checksum = self.ps.part.checksum
+            if checksum is None:
+                self.write("OK")
+            else:
+                self.write("OK\n" + checksum.format_line(self.session.filename))
+        else:
+            self.write(str(self.session.offset))
+
+
+metrics.GaugeFunc("dzbackup_uploads_in_flight", "Uploads being processed.", lambda: DropFileHandler.in_flight)
+
+
+class TokenHandler(RequestHandler):
+    """POST /token verifies the Username and Password headers, and returns an upload token in the body.
+
+    The token can be sent in an "Authorization: Bearer <token>" header instead of the password, until the time
+    given in the Token-Expires header of the response.
+    """
+    config: Config
+
+    def initialize(self, config: Config) -> None:
+        self.config = config
+
+    async def post(self):
+        self.set_header("Content-Type", "text/plain")
+        self.set_header("Cache-Control", "no-store")
+        username = get_username(self.request.headers)
+        if username is None:
+            self.set_status(401)
+            self.write("Unauthorized - Username and Password headers are required.")
+            return
+        auth = await check_password(self.config, username, self.request.headers.get("Password", None))
+        fingerprint = self.config.security_manager.get_fingerprint(username)
+        if not auth.ok or fingerprint is None:
+            self.set_status(403)
+            self.write("Invalid username or password.")
+            return
+        token, expires = self.config.token_signer.issue(username, fingerprint, self.config.token_ttl)
+        self.set_header(EXPIRES_HEADER, str(expires))
+        self.write(token)
+
+
+class MetricsHandler(RequestHandler):
+    """Export the metrics of the process in the Prometheus text format."""
+
+    def get(self):
+        self.set_header("Content-Type", metrics.CONTENT_TYPE)
+        self.set_header("Cache-Control", "no-store")
+        self.write(metrics.REGISTRY.format())
 
 
 class Server:
+    """The upload server.
+
+    With a single worker, the server runs in the current process. With more workers, the current process becomes
+    the master process. It owns the pid file and the background threads, and it forks the worker processes that
+    serve requests on a shared listening socket. Workers that exit unexpectedly are restarted. Every worker has its
+    own copy of the security manager, so it reloads the passwd file on its own.
+
+    On SIGTERM, workers stop accepting new connections and wait for in-flight uploads to finish (but not longer
+    than shutdown_timeout seconds) before they exit.
+    """
+
     def __init__(self, config: Config):
         self.config = config
         self.enabled = threading.Event()
+        self.sockets = None
+        self.http_server = None
+        self.worker_pids = None  # Maps pids of worker processes to worker ids, in the master process only.
 
     def start(self):
-        if self.config.debug:
-            print("Config:", self.config)
+        log.debug("Config: %s", self.config)
         self.enabled.set()
         create_pid_file_or_exit(self.config.pid_file_path, auto_remove_pid_file=self.config.auto_remove_pid_file)
+        workers = self.config.workers or 1
+        self.config.user_limiter = UserLimiter(workers)
+        if self.config.token_ttl:
+            self.config.token_signer = TokenSigner(load_secret(self.config.token_secret_file))
+        else:
+            self.config.token_signer = None
+        self.rebuild_usage_index()
+        self.sockets = bind_sockets(self.config.port, self.config.listen_address, reuse_port=workers > 1)
+        if workers > 1:
+            self.worker_pids = {}
+            for worker_id in range(workers):
+                self.spawn_worker(worker_id)
+            self.setup_signal_handlers()
+            self.start_background_threads()
+            self.supervise_workers()
+        else:
+            self.setup_signal_handlers()
+            self.start_background_threads()
+            self.run_worker()
+
+    def rebuild_usage_index(self):
+        """Scan the upload directories before the workers are started, so the index starts consistent."""
+        started = time.perf_counter()
+        usage_index = UsageIndex(self.config.usage_db)
+        exclude = []
+        if self.config.dedup_dir:
+            exclude.append(os.path.join(self.config.upload_base_dir, self.config.dedup_dir))
+        result = usage_index.rebuild(
+            get_upload_dirs(self.config.security_manager, self.config.upload_base_dir, self.config.anonymous_dir),
+            self.config.tmp_suffix, exclude, self.config.usage_scan_threads)
+        usage_index.close()
+        log.info("Usage index rebuilt in %.2f seconds: %d directories, %d files, %.1f MB",
+                 time.perf_counter() - started, len(result), sum(files for _, files in result.values()),
+                 sum(size for size, _ in result.values()) / MB)
+
+    def spawn_worker(self, worker_id):
+        pid = os.fork()
+        if pid:
+            self.worker_pids[pid] = worker_id
+            return
+        # Worker process. It must never return into the code of the master process, and it must not run the
+        # atexit handlers of the master (they would remove the pid file).
+        exit_code = 0
+        try:
+            setup_logging(self.config)
+            self.worker_pids = None
+            signal.signal(signal.SIGINT, signal.SIG_IGN)  # Interrupts are handled by the master process.
+            for sig in [signal.SIGABRT, signal.SIGTERM]:
+                signal.signal(sig, self.on_kill)
+            log.info("Worker %d started with pid %d", worker_id, os.getpid())
+            self.run_worker(worker_id)
+        except BaseException:
+            log.exception("Worker %d failed", worker_id)
+            exit_code = 1
+        finally:
+            stop_logging()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exit_code)
+
+    def supervise_workers(self):
+        while self.worker_pids:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            worker_id = self.worker_pids.pop(pid, None)
+            if worker_id is not None:
+                self.config.user_limiter.reset_worker(worker_id)
+            if worker_id is not None and self.enabled.is_set():
+                log.warning("Worker %d (pid %d) exited unexpectedly with status %d, restarting.",
+                            worker_id, pid, status)
+                self.spawn_worker(worker_id)
+
+    def run_worker(self, worker_id=0):
+        self.config.user_limiter.worker_id = worker_id
+        self.config.password_verifier = PasswordVerifier(self.config.auth_workers)
+        self.config.disk_writer = DiskWriter(self.config.writer_threads, self.config.write_queue_size)
+        if self.config.dedup_dir:
+            self.config.dedup_store = DedupStore(os.path.join(self.config.upload_base_dir, self.config.dedup_dir))
+        else:
+            self.config.dedup_store = None
+        self.config.usage_index = UsageIndex(self.config.usage_db)
+        self.config.staging = StagingArea()
+        if self.config.durability == "group":
+            self.config.group_committer = GroupCommitter()
+            self.config.group_committer.start()
+        else:
+            self.config.group_committer = None
         handlers = [
             url(r"/upload", DropFileHandler, dict(config=self.config)),
-            url(r"/(.*)", StaticFileHandler, dict(path=self.config.static_dir_path, default_filename="index.html")),
+            url(r"/upload/([^/]+)", RawDropFileHandler, dict(config=self.config)),
+            url(r"/sessions(?:/([^/]+))?", SessionHandler, dict(config=self.config)),
         ]
-        application = Application(handlers)
-        http_server = HTTPServer(
+        if self.config.token_signer is not None:
+            handlers.append(url(r"/token", TokenHandler, dict(config=self.config)))
+        metrics.REGISTRY.const_labels["worker"] = str(worker_id)
+        disk_writer = self.config.disk_writer
+        metrics.GaugeFunc("dzbackup_write_queue_bytes", "Bytes waiting to be written to the disk.",
+                          lambda: disk_writer.queued_bytes)
+        if self.config.metrics_port:
+            # Every worker serves its own metrics on its own port, so that all of them can be scraped.
+            metrics_server = HTTPServer(Application([url(r"/metrics", MetricsHandler)]))
+            metrics_server.listen(self.config.metrics_port + worker_id, self.config.listen_address)
+        elif self.config.metrics:
+            handlers.append(url(r"/metrics", MetricsHandler))
+        handlers.append(
+            url(r"/(.*)", StaticFileHandler, dict(path=self.config.static_dir_path, default_filename="index.html")))
+        application = Application(handlers, log_function=log_request)
+        self.http_server = HTTPServer(
             application,
             max_body_size=MAX_BODY_SIZE,
             max_buffer_size=MAX_BUFFER_SIZE,
         )
-        http_server.listen(self.config.port, self.config.listen_address)
-        self.setup_signal_handlers()
-        self.start_background_threads()
+        self.http_server.add_sockets(self.sockets)
         IOLoop.current().start()
+        self.config.password_verifier.shutdown()
+        self.config.disk_writer.shutdown()
 
     def stop(self):
-        self.enabled.clear()
+        """Stop the server gracefully. When called for the second time, stop immediately."""
         ioloop = IOLoop.current()
-        ioloop.add_callback_from_signal(ioloop.stop)
+        if self.enabled.is_set():
+            self.enabled.clear()
+            ioloop.add_callback_from_signal(self.drain)
+        else:
+            ioloop.add_callback_from_signal(ioloop.stop)
+
+    async def drain(self):
+        """Stop accepting connections, wait for in-flight uploads, then stop the IOLoop."""
+        self.http_server.stop()
+        deadline = time.monotonic() + self.config.shutdown_timeout
+        while DropFileHandler.in_flight and time.monotonic() < deadline:
+            await gen.sleep(0.1)
+        if DropFileHandler.in_flight:
+            log.warning("Shutdown timeout, aborting %d upload(s).", DropFileHandler.in_flight)
+        IOLoop.current().stop()
 
     def setup_signal_handlers(self):
         for sig in [signal.SIGABRT, signal.SIGINT, signal.SIGTERM]:
             signal.signal(sig, self.on_kill)
 
     def on_kill(self, sig, frame):
-        sys.stderr.write("Received %s, exiting...\n" % SIGNAL_NAMES[sig])
-        sys.stderr.flush()
-        self.stop()
+        log.warning("Received %s, exiting...", SIGNAL_NAMES[sig])
+        if self.worker_pids is None:
+            self.stop()
+        else:
+            # Master process: workers drain on the first signal and exit immediately on the second one.
+            self.enabled.clear()
+            for pid in list(self.worker_pids):
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
 
     def start_background_threads(self):
-        # TODO: Start background threads in the master process only.
+        # Background threads are started in the master process only.
         # EmailConfirmSender(self).start()
         # PasswordResetSender(self).start()
-        pass
+        SessionReaper(self).start()
 
 
 def main(config: Config):
-    Server(config).start()
+    setup_logging(config)
+    try:
+        Server(config).start()
+    finally:
+        stop_logging()
@@ -0,0 +1,305 @@
+"""Storage of resumable upload sessions.
+
+Sessions are stored in the SESSION_DIR_NAME subdirectory of the upload directory of the user, so they survive
+restarts and the data file is on the same file system as the final destination of the upload. Every session has
+an index file (<session_id>.json), a data file (<session_id>.data) that is preallocated to the full length of the
+upload, and a lock file (<session_id>.lock) that serializes updates of the index.
+"""
+import os
+import re
+import json
+import time
+import errno
+import secrets
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows: sessions are not locked, but there is a single server process anyway.
+
+from .error import AbortRequest
+from .logs import log
+from .security import SecurityManager, get_upload_dirs
+from .staging import expire_staged_files
+
+SESSION_DIR_NAME = ".dzsessions"
+_index_lock = threading.Lock()  # Used instead of file locks when fcntl is not available
+PAT_SESSION_ID = re.compile("^[0-9a-f]{32}$")
+
+
+def get_session_dir(upload_dir):
+    return os.path.join(upload_dir, SESSION_DIR_NAME)
+
+
+def format_ranges(ranges):
+    """Format a list of [start, end) ranges like 0-99,200-299 (with inclusive ends, as in Content-Range)."""
+    return ",".join("%d-%d" % (start, end - 1) for start, end in ranges)
+
+
+class UploadSession(object):
+    """A resumable upload session.
+
+    The session records the byte ranges that have been written into the data file. They are saved into the index
+    file after every request, and also when the client disconnects in the middle of a request. Ranges can be
+    written in any order and in parallel, over multiple connections. The committed offset is the end of the
+    contiguous range that starts at zero, sequential uploads continue from there.
+    """
+
+    def __init__(self, upload_dir, session_id, filename, length, ranges=None, created=None, updated=None,
+                 checksum=None):
+        self.upload_dir = upload_dir
+        self.session_id = session_id
+        self.filename = filename
+        self.length = length
+        self.ranges = ranges or []  # Sorted list of disjoint [start, end) ranges that have been written
+        self.created = created or time.time()
+        self.updated = updated or self.created
+        self.checksum = checksum  # Checksum sent by the client when the session was created
+        self._lock_file = None
+        self._exclusive = False
+
+    @property
+    def index_path(self):
+        return os.path.join(get_session_dir(self.upload_dir), self.session_id + ".json")
+
+    @property
+    def data_path(self):
+        return os.path.join(get_session_dir(self.upload_dir), self.session_id + ".data")
+
+    @property
+    def lock_path(self):
+        return os.path.join(get_session_dir(self.upload_dir), self.session_id + ".lock")
+
+    @property
+    def final_path(self):
+        return os.path.join(self.upload_dir, self.filename)
+
+    @property
+    def offset(self):
+        if self.ranges and self.ranges[0][0] == 0:
+            return self.ranges[0][1]
+        else:
+            return 0
+
+    @property
+    def is_complete(self):
+        return self.offset == self.length
+
+    def add_range(self, start, end):
+        """Record that the [start, end) range has been written."""
+        if start >= end:
+            return
+        merged = []
+        for r_start, r_end in self.ranges:
+            if r_end < start or r_start > end:
+                merged.append([r_start, r_end])
+            else:
+                start, end = min(start, r_start), max(end, r_end)
+        merged.append([start, end])
+        merged.sort()
+        self.ranges = merged
+
+    def get_missing_ranges(self):
+        missing, pos = [], 0
+        for start, end in self.ranges + [[self.length, self.length]]:
+            if start > pos:
+                missing.append([pos, start])
+            pos = max(pos, end)
+        return missing
+
+    @classmethod
+    def create(cls, upload_dir, filename, length, checksum=None) -> "UploadSession":
+        session_dir = get_session_dir(upload_dir)
+        if not os.path.isdir(session_dir):
+            os.makedirs(session_dir)
+        session = cls(upload_dir, secrets.token_hex(16), filename, length, checksum=checksum)
+        open(session.data_path, "xb").close()
+        session.save()
+        return session
+
+    def preallocate(self):
+        """Allocate disk space for the whole file. This can be slow, call it from a writer thread."""
+        if not self.length:
+            return
+        with open(self.data_path, "r+b") as fout:
+            try:
+                if hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(fout.fileno(), 0, self.length)
+                else:
+                    fout.truncate(self.length)
+            except OSError as e:
+                if e.errno in (errno.ENOSPC, errno.EDQUOT):
+                    self.delete()
+                    raise AbortRequest(507, "Insufficient Storage.")
+                elif e.errno in (errno.EOPNOTSUPP, errno.EINVAL):
+                    fout.truncate(self.length)  # Not supported by the file system, create a sparse file.
+                else:
+                    raise
+
+    @classmethod
+    def load(cls, upload_dir, session_id) -> "UploadSession":
+        if not PAT_SESSION_ID.match(session_id):
+            raise AbortRequest(404, "Upload session not found.")
+        index_path = os.path.join(get_session_dir(upload_dir), session_id + ".json")
+        try:
+            with open(index_path, "r") as fin:
+                data = json.load(fin)
+        except FileNotFoundError:
+            raise AbortRequest(404, "Upload session not found.")
+        return cls(upload_dir, session_id, data["filename"], data["length"], data["ranges"],
+                   data["created"], data["updated"], data.get("checksum"))
+
+    def reload(self):
+        """Reload the index file, e.g. after the session has been locked."""
+        loaded = self.load(self.upload_dir, self.session_id)
+        self.filename, self.length, self.ranges = loaded.filename, loaded.length, loaded.ranges
+        self.created, self.updated = loaded.created, loaded.updated
+        self.checksum = loaded.checksum
+
+    def save(self):
+        """Atomically replace the index file."""
+        self.updated = time.time()
+        tmp_path = self.index_path + ".part"
+        with open(tmp_path, "w") as fout:
+            json.dump({
+                "filename": self.filename,
+                "length": self.length,
+                "ranges": self.ranges,
+                "created": self.created,
+                "updated": self.updated,
+                "checksum": self.checksum,
+            }, fout)
+        os.replace(tmp_path, self.index_path)
+
+    def delete(self):
+        """Remove the files of the session."""
+        for path in [self.index_path, self.data_path, self.lock_path]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def lock(self, shared=False):
+        """Lock the session, so that it cannot be written by two requests at the same time (even from different
+        processes). Raises AbortRequest(409) when it is locked by another request.
+
+        :param shared: Acquire a shared lock. Requests writing different ranges of the data file can hold shared
+            locks at the same time.
+        """
+        try:
+            self._lock_file = open(self.data_path, "r+b")
+        except FileNotFoundError:
+            raise AbortRequest(404, "Upload session not found.")
+        self._exclusive = not shared
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._lock_file.fileno(), (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.unlock()
+                raise AbortRequest(409, "Conflict - the upload session is being written by another request.")
+
+    @property
+    def is_locked(self):
+        return self._lock_file is not None
+
+    def lock_exclusive(self) -> bool:
+        """Try to upgrade a shared lock to an exclusive lock, without waiting. Call it under index_lock(), see
+        SessionStreamedPart._save_range().
+
+        :return: False when other requests are still holding the session. The shared lock may have been released
+            then (flock() does not convert locks atomically), so the session must be unlocked.
+        """
+        if not self._exclusive and fcntl is not None:
+            try:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+        self._exclusive = True
+        return True
+
+    def unlock(self):
+        if self._lock_file is not None:
+            self._lock_file.close()  # Closing the file also releases the lock
+            self._lock_file = None
+
+    @contextmanager
+    def index_lock(self):
+        """Serialize read-modify-write cycles of the index file. Blocks, so only use it from writer threads."""
+        if fcntl is None:
+            with _index_lock:
+                yield
+        else:
+            with open(self.lock_path, "a+b") as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                yield
+
+
+def expire_sessions(upload_dir, ttl) -> int:
+    """Delete sessions of an upload directory that were not updated for ttl seconds.
+
+    :return: Number of sessions deleted.
+    """
+    session_dir = get_session_dir(upload_dir)
+    try:
+        names = os.listdir(session_dir)
+    except FileNotFoundError:
+        return 0
+    deadline = time.time() - ttl
+    deleted = 0
+    for name in names:
+        session_id, ext = os.path.splitext(name)
+        if not PAT_SESSION_ID.match(session_id):
+            continue
+        session = UploadSession(upload_dir, session_id, None, None)
+        if ext == ".lock" and not os.path.exists(session.data_path):
+            try:
+                if os.stat(session.lock_path).st_mtime < deadline:
+                    os.unlink(session.lock_path)  # Left behind by a request that was racing with a commit
+            except OSError:
+                pass
+        if ext != ".data":
+            continue
+        try:
+            # The index may be missing if the server was killed while creating the session.
+            mtime = max(os.stat(path).st_mtime for path in [session.data_path, session.index_path]
+                        if os.path.exists(path))
+            if mtime >= deadline:
+                continue
+            session.lock()
+        except (AbortRequest, OSError, ValueError):
+            continue  # Being written, or deleted in the meantime
+        try:
+            session.delete()
+            deleted += 1
+        finally:
+            session.unlock()
+    return deleted
+
+
+class SessionReaper(threading.Thread):
+    """Background thread that periodically deletes stale upload sessions and temporary files of all users."""
+
+    def __init__(self, server):
+        super().__init__(name="session-reaper", daemon=True)
+        self.server = server
+        self.config = server.config
+        # The security manager of the server must only be used by the IOLoop thread.
+        self.security_manager = SecurityManager(self.config.security_manager.passwdfile)
+
+    def run(self):
+        interval = min(self.config.session_ttl / 10, 3600)
+        while self.server.enabled.is_set():
+            try:
+                for upload_dir in get_upload_dirs(self.security_manager, self.config.upload_base_dir,
+                                                   self.config.anonymous_dir):
+                    deleted = expire_sessions(upload_dir, self.config.session_ttl)
+                    if deleted:
+                        log.info("Deleted %d stale upload session(s) from %s", deleted, upload_dir)
+                    deleted = expire_staged_files(upload_dir, self.config.session_ttl)
+                    if deleted:
+                        log.info("Deleted %d stale temporary file(s) from %s", deleted, upload_dir)
+            except Exception as e:
+                log.error("Error while deleting stale upload sessions: %s", e)
+            time.sleep(interval)
@@ -0,0 +1,145 @@
+"""Staging of uploaded files.
+
+Uploaded data is written into a temporary file, and the finished file is renamed to its final name. Temporary files
+are created in the STAGING_DIR_NAME subdirectory of the upload directory, so they are not visible next to the
+uploaded files, and they are always on the same file system as their destination: the commit is a single atomic
+rename, never a copy.
+
+When existing files must not be overwritten, the commit uses renameat2() with RENAME_NOREPLACE (Linux only), so
+the check for an existing file and the rename cannot race with another upload of the same name. Where it is not
+available, a hard link is created and the temporary file is unlinked, which fails the same way when the destination
+exists.
+"""
+import os
+import time
+import ctypes
+import errno
+import tempfile
+import threading
+
+STAGING_DIR_NAME = ".dzstaging"
+AT_FDCWD = -100
+RENAME_NOREPLACE = 1
+# Errors of renameat2() meaning that the flag is not supported by the kernel or the file system.
+NOREPLACE_NOT_SUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.ENOTSUP)
+# Errors of os.link() meaning that the file system does not support hard links.
+LINK_NOT_SUPPORTED = (errno.EPERM, errno.ENOTSUP, errno.EMLINK)
+
+
+def _load_renameat2():
+    """Get renameat2() from the C library (Linux, glibc 2.28+), or None."""
+    try:
+        renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    except (OSError, AttributeError):
+        return None
+    renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    return renameat2
+
+
+_renameat2 = _load_renameat2()
+
+
+def get_staging_dir(upload_dir):
+    return os.path.join(upload_dir, STAGING_DIR_NAME)
+
+
+def rename_noreplace(src_path, dst_path):
+    """Atomically rename a file, unless the destination exists. Raises FileExistsError when it does."""
+    if _renameat2 is not None:
+        if _renameat2(AT_FDCWD, os.fsencode(src_path), AT_FDCWD, os.fsencode(dst_path), RENAME_NOREPLACE) == 0:
+            return
+        err = ctypes.get_errno()
+        if err not in NOREPLACE_NOT_SUPPORTED:
+            raise OSError(err, os.strerror(err), src_path, None, dst_path)
+    try:
+        os.link(src_path, dst_path)
+    except OSError as e:
+        if e.errno not in LINK_NOT_SUPPORTED:
+            raise
+        # No atomic way on this file system.
+        if os.path.lexists(dst_path):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), dst_path)
+        os.rename(src_path, dst_path)
+    else:
+        os.unlink(src_path)
+
+
+def commit_file(src_path, dst_path, replace):
+    """Move a staged file to its final location.
+
+    :param replace: Replace an existing file. Otherwise FileExistsError is raised when the destination exists.
+    """
+    if replace:
+        os.replace(src_path, dst_path)
+    else:
+        rename_noreplace(src_path, dst_path)
+
+
+def expire_staged_files(upload_dir, ttl) -> int:
+    """Delete temporary files of an upload directory that were not updated for ttl seconds, e.g. because the server
+    was killed while writing them.
+
+    :return: Number of files deleted.
+    """
+    try:
+        entries = list(os.scandir(get_staging_dir(upload_dir)))
+    except FileNotFoundError:
+        return 0
+    deadline = time.time() - ttl
+    deleted = 0
+    for entry in entries:
+        try:
+            if entry.is_file(follow_symlinks=False) and entry.stat().st_mtime < deadline:
+                os.unlink(entry.path)
+                deleted += 1
+        except FileNotFoundError:
+            pass
+    return deleted
+
+
+class StagingArea(object):
+    """Creates temporary files for uploads. Directories that are known to exist are cached, so uploading many small
+    files does not cost additional system calls to check or create them. Used by the IOLoop and writer threads."""
+
+    def __init__(self, max_dirs=10000):
+        self.max_dirs = max_dirs
+        self._dirs = set()  # Upload dirs with an existing staging dir
+        self._lock = threading.Lock()
+
+    def _ensure_dirs(self, upload_dir, create):
+        """Make sure that the upload dir and its staging dir exist.
+
+        :param create: Create the upload dir when it does not exist. Otherwise FileNotFoundError is raised.
+        """
+        with self._lock:
+            if upload_dir in self._dirs:
+                return
+        if create:
+            os.makedirs(upload_dir, exist_ok=True)
+        elif not os.path.isdir(upload_dir):
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), upload_dir)
+        os.makedirs(get_staging_dir(upload_dir), exist_ok=True)
+        with self._lock:
+            if len(self._dirs) >= self.max_dirs:
+                self._dirs.clear()
+            self._dirs.add(upload_dir)
+
+    def forget(self, upload_dir):
+        """Remove an upload dir from the cache, e.g. because it has been deleted."""
+        with self._lock:
+            self._dirs.discard(upload_dir)
+
+    def create_temp_file(self, upload_dir, suffix, create=True):
+        """Create a temporary file on the file system of the upload dir.
+
+        :param create: Create the upload dir when it does not exist. Otherwise FileNotFoundError is raised.
+        :return: A NamedTemporaryFile that is not deleted when closed.
+        """
+        for retry in (False, True):
+            self._ensure_dirs(upload_dir, create)
+            try:
+                return tempfile.NamedTemporaryFile(dir=get_staging_dir(upload_dir), suffix=suffix, delete=False)
+            except FileNotFoundError:
+                if retry:
+                    raise
+                self.forget(upload_dir)  # Deleted since it has been cached
@@ -0,0 +1,88 @@
+"""Short-lived upload tokens.
+
+A client that uploads many files can exchange its password for a token once (POST /token), and send the token in an
+"Authorization: Bearer" header instead of the password. Tokens are signed with HMAC-SHA256, so they are checked
+without an Argon2 verification. A token contains the name of the user, its expiry time, and a fingerprint of the
+passwd entry of the user: when the password, the prefix or the options of the user change, or the user is deleted,
+the fingerprint does not match anymore and the token is rejected.
+
+All workers must use the same secret, so it is created by the master process before forking the workers, or read
+from a file to keep tokens valid across restarts.
+"""
+import os
+import hmac
+import time
+import base64
+import hashlib
+import binascii
+
+from .error import AbortRequest
+
+SECRET_SIZE = 32
+TOKEN_HEADER = "Authorization"
+TOKEN_SCHEME = "Bearer"
+EXPIRES_HEADER = "Token-Expires"  # Expiry time of the token issued, in seconds since the epoch
+
+
+def load_secret(path=None) -> bytes:
+    """Read the secret from a file, or create it when the file does not exist.
+
+    :param path: Path of the secret file. When not given, a new random secret is returned.
+    """
+    if not path:
+        return os.urandom(SECRET_SIZE)
+    try:
+        with open(path, "rb") as fin:
+            secret = fin.read()
+    except FileNotFoundError:
+        secret = os.urandom(SECRET_SIZE)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as fout:
+            fout.write(secret)
+    if len(secret) < 16:
+        raise ValueError("The token secret in %s is too short." % path)
+    return secret
+
+
+def b64encode(data) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def b64decode(text) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+class TokenSigner(object):
+    def __init__(self, secret):
+        self.secret = secret
+
+    def _sign(self, payload) -> bytes:
+        return hmac.new(self.secret, payload, hashlib.sha256).digest()
+
+    def issue(self, username, fingerprint, ttl):
+        """Create a token.
+
+        :param fingerprint: Fingerprint of the passwd entry of the user, see SecurityManager.get_fingerprint()
+        :param ttl: Number of seconds the token is valid for.
+        :return: A tuple of (token, expiry time)
+        """
+        expires = int(time.time() + ttl)
+        payload = ("%s:%d:%s" % (username, expires, fingerprint)).encode("UTF-8")
+        return b64encode(payload) + "." + b64encode(self._sign(payload)), expires
+
+    def verify(self, token):
+        """Check the signature and the expiry time of a token.
+
+        :return: A tuple of (username, fingerprint). The caller must compare the fingerprint with the current one.
+        """
+        try:
+            payload_text, signature = token.split(".")
+            payload = b64decode(payload_text)
+            valid = hmac.compare_digest(self._sign(payload), b64decode(signature))
+            username, expires, fingerprint = payload.decode("UTF-8").split(":")
+            expires = int(expires)
+        except (ValueError, binascii.Error):
+            valid = False
+        if not valid or expires < time.time():
+            raise AbortRequest(403, "Invalid or expired token.")
+        return username, fingerprint
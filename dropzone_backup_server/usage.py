@@ -0,0 +1,202 @@
+"""Index of the storage used by the upload directories.
+
+The index is an SQLite database that holds the total size and the number of files of every upload directory. It
+is rebuilt by a parallel scan when the server starts, and updated incrementally when uploaded files are committed
+or overwritten, so quotas can be checked without walking the directories. Only committed files are counted:
+temporary files and upload sessions are not.
+
+Files with more than one hard link (e.g. deduplicated files, see dedup.py) share their disk space, so every inode is
+counted only once in an upload directory, no matter how many of its files link to it. The index keeps the number
+of links of these inodes, so the space is released when the last one is deleted or overwritten.
+
+Files that are added or deleted by other programs are only taken into account by the next scan.
+"""
+import os
+import time
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from .sessions import SESSION_DIR_NAME
+from .staging import STAGING_DIR_NAME
+
+USAGE_DB_NAME = ".dzusage.sqlite"  # Default name of the index in the upload base dir
+
+
+def scan_dir(path, tmp_suffix, exclude=()):
+    """Scan a single directory, without recursion.
+
+    :param exclude: Absolute paths of directories that are skipped, e.g. the dedup store.
+    :return: A tuple of (bytes, files, subdirectories, links). Files with more than one hard link are not added to
+        bytes, they are returned in links as (st_dev, st_ino, size) tuples instead.
+    """
+    size, files, subdirs, links = 0, 0, [], []
+    try:
+        entries = list(os.scandir(path))
+    except (FileNotFoundError, NotADirectoryError):
+        return 0, 0, [], []
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name not in (SESSION_DIR_NAME, STAGING_DIR_NAME) and entry.path not in exclude:
+                    subdirs.append(entry.path)
+            elif entry.is_file(follow_symlinks=False) and not entry.name.endswith(tmp_suffix) \
+                    and not entry.name.startswith(USAGE_DB_NAME):  # Also the -wal and -shm files of SQLite
+                st = entry.stat(follow_symlinks=False)
+                if st.st_nlink > 1:
+                    links.append((st.st_dev, st.st_ino, st.st_size))
+                else:
+                    size += st.st_size
+                files += 1
+        except FileNotFoundError:
+            pass  # Deleted while scanning
+    return size, files, subdirs, links
+
+
+def scan_dirs(paths, tmp_suffix, exclude=(), threads=16, links=None) -> dict:
+    """Compute the usage of directory trees. Directories are scanned in parallel, so deep and wide trees are
+    scanned equally fast. Inodes with more than one hard link are counted once in every tree.
+
+    :param links: When given, it is filled with a dict of path -> {(st_dev, st_ino): [size, number of links]} of
+        the inodes with more than one hard link.
+    :return: A dict of path -> (bytes, files)
+    """
+    result = {path: [0, 0] for path in paths}
+    if links is None:
+        links = {}
+    links.update({path: {} for path in paths})
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="scanner") as executor:
+        pending = {executor.submit(scan_dir, path, tmp_suffix, exclude): path for path in result}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                root = pending.pop(future)
+                size, files, subdirs, dir_links = future.result()
+                result[root][0] += size
+                result[root][1] += files
+                for dev, ino, link_size in dir_links:
+                    link = links[root].setdefault((dev, ino), [link_size, 0])
+                    if not link[1]:
+                        result[root][0] += link_size
+                    link[1] += 1
+                for subdir in subdirs:
+                    pending[executor.submit(scan_dir, subdir, tmp_suffix, exclude)] = root
+    return {path: tuple(value) for path, value in result.items()}
+
+
+class UsageIndex(object):
+    def __init__(self, path):
+        """Open the index, create it when it does not exist.
+
+        :param path: Path of the SQLite database.
+        """
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS usage ("
+                         "dir TEXT PRIMARY KEY, bytes INTEGER NOT NULL, files INTEGER NOT NULL, scanned REAL)")
+            # Inodes with more than one hard link in an upload directory, their size is counted once.
+            conn.execute("CREATE TABLE IF NOT EXISTS links ("
+                         "dir TEXT NOT NULL, dev INTEGER NOT NULL, ino INTEGER NOT NULL, size INTEGER NOT NULL, "
+                         "count INTEGER NOT NULL, PRIMARY KEY (dir, dev, ino))")
+
+    def _connect(self) -> sqlite3.Connection:
+        """Get the connection of the current thread. Connections cannot be shared between threads."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def get(self, upload_dir):
+        """Get the usage of an upload directory.
+
+        :return: A tuple of (bytes, files)
+        """
+        row = self._connect().execute("SELECT bytes, files FROM usage WHERE dir = ?",
+                                      (os.path.abspath(upload_dir),)).fetchone()
+        return tuple(row) if row else (0, 0)
+
+    def add(self, upload_dir, size, files):
+        """Change the usage of an upload directory.
+
+        :param size: Bytes added (or removed, when negative).
+        :param files: Number of files added (or removed, when negative).
+        """
+        with self._connect() as conn:
+            self._add(conn, os.path.abspath(upload_dir), size, files)
+
+    @staticmethod
+    def _add(conn, upload_dir, size, files):
+        conn.execute("INSERT INTO usage (dir, bytes, files) VALUES (?, ?, ?) ON CONFLICT (dir) DO UPDATE "
+                     "SET bytes = bytes + excluded.bytes, files = files + excluded.files",
+                     (upload_dir, size, files))
+
+    def replace_file(self, upload_dir, old_stat, new_stat):
+        """Record that a file of an upload directory has been created, overwritten or deleted.
+
+        :param old_stat: os.stat() of the file before it was changed, or None when it did not exist.
+        :param new_stat: os.stat() of the file after it was changed, or None when it has been deleted.
+        """
+        upload_dir = os.path.abspath(upload_dir)
+        with self._connect() as conn:
+            size = 0
+            if old_stat is not None:
+                size -= self._change_links(conn, upload_dir, old_stat, -1)
+            if new_stat is not None:
+                size += self._change_links(conn, upload_dir, new_stat, 1)
+            self._add(conn, upload_dir, size, (new_stat is not None) - (old_stat is not None))
+
+    @staticmethod
+    def _change_links(conn, upload_dir, st, delta) -> int:
+        """Add delta to the number of links of the inode of a file in the upload directory.
+
+        :return: The number of bytes that the file adds to (or removes from) the usage of the directory: its size
+            for the first (or last) link of the inode, zero for the others.
+        """
+        key = (upload_dir, st.st_dev, st.st_ino)
+        row = conn.execute("SELECT size, count FROM links WHERE dir = ? AND dev = ? AND ino = ?", key).fetchone()
+        if row is None:
+            if delta > 0 and st.st_nlink > 1:
+                conn.execute("INSERT INTO links (dir, dev, ino, size, count) VALUES (?, ?, ?, ?, 1)",
+                             key + (st.st_size,))
+            return st.st_size  # A file with a single link, or the first link of the inode
+        size, count = row
+        if count + delta <= 0:
+            conn.execute("DELETE FROM links WHERE dir = ? AND dev = ? AND ino = ?", key)
+            return size
+        conn.execute("UPDATE links SET count = ? WHERE dir = ? AND dev = ? AND ino = ?", (count + delta,) + key)
+        return 0
+
+    def rebuild(self, upload_dirs, tmp_suffix, exclude=(), threads=16) -> dict:
+        """Scan the upload directories and replace the index with the results. Uploads committed while scanning
+        may be counted twice or not at all, so call this before the server starts.
+
+        :return: A dict of path -> (bytes, files)
+        """
+        started = time.time()
+        exclude = set(os.path.abspath(path) for path in exclude)
+        links = {}
+        result = scan_dirs(set(os.path.abspath(path) for path in upload_dirs), tmp_suffix, exclude, threads, links)
+        with self._connect() as conn:
+            conn.execute("DELETE FROM usage")
+            conn.execute("DELETE FROM links")
+            conn.executemany("INSERT INTO usage (dir, bytes, files, scanned) VALUES (?, ?, ?, ?)",
+                             [(path, size, files, started) for path, (size, files) in result.items()])
+            conn.executemany("INSERT INTO links (dir, dev, ino, size, count) VALUES (?, ?, ?, ?, ?)",
+                             [(path, dev, ino, size, count) for path, inodes in links.items()
+                              for (dev, ino), (size, count) in inodes.items()])
+        return result
+
+    def get_all(self) -> dict:
+        """Get the usage of all upload directories, as a dict of path -> (bytes, files)"""
+        return {row[0]: (row[1], row[2]) for row in
+                self._connect().execute("SELECT dir, bytes, files FROM usage ORDER BY dir")}
+
+    def close(self):
+        """Close the connection of the current thread."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
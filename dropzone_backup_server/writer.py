@@ -0,0 +1,286 @@
+import os
+import time
+import errno
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado.concurrent import Future, future_set_result_unless_cancelled
+from tornado.ioloop import IOLoop
+
+from .error import AbortRequest
+from .metrics import WRITE_LATENCY
+
+
+def pwrite_all(fd, data, offset):
+    """Write all data into a file at the given position, without moving the file pointer if possible."""
+    view = memoryview(data)
+    if hasattr(os, "pwrite"):
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while view:
+            view = view[os.write(fd, view):]
+
+
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16  # POSIX minimum
+
+
+def writev_all(fd, buffers):
+    """Write a list of buffers at the position of the file pointer, with as few system calls as possible."""
+    if not hasattr(os, "writev"):
+        for data in buffers:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        return
+    buffers = list(buffers)
+    while buffers:
+        batch = buffers[:IOV_MAX]
+        written = os.writev(fd, batch)
+        count = 0
+        for data in batch:
+            if written < len(data):
+                break
+            written -= len(data)
+            count += 1
+        del buffers[:count]
+        if written:  # Partial write in the middle of a buffer
+            buffers[0] = memoryview(buffers[0])[written:]
+
+
+def preallocate(fd, size):
+    """Allocate disk space for a file, so that it is written into large contiguous extents. This also sets the size
+    of the file. Returns False when the file system does not support it."""
+    if not size or not hasattr(os, "posix_fallocate"):
+        return False
+    try:
+        os.posix_fallocate(fd, 0, size)
+        return True
+    except OSError as e:
+        if e.errno in (errno.EOPNOTSUPP, errno.EINVAL):
+            return False
+        raise
+
+
+class DiskWriter(object):
+    """A pool of threads that write uploaded data to the disk, so that slow storage never blocks the IOLoop.
+
+    Every upload gets its own WriteQueue. Operations of a queue are executed in order, by one thread at a time.
+    """
+
+    def __init__(self, threads, queue_size, batch_size=256 * 1024):
+        """Create a new disk writer.
+
+        :param threads: Number of writer threads. When zero, operations are executed synchronously by the thread
+            that submits them.
+        :param queue_size: Max. number of bytes queued for a single upload. When a queue is full, the request
+            handler should stop reading from the connection until the queue has space again.
+        :param batch_size: Writing starts when this many bytes are queued, or when an operation without data
+            (e.g. a commit) is submitted.
+        """
+        self.threads = threads
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        if threads:
+            self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="writer")
+        else:
+            self.executor = None
+        self._lock = threading.Lock()
+        self.queued_bytes = 0  # Total number of bytes waiting in all queues
+        self.writes = 0  # Total number of write operations
+        self.write_time = 0.0  # Total time spent in write operations, in seconds
+        self.max_write_time = 0.0  # Slowest write operation, in seconds
+
+    def open_queue(self) -> "WriteQueue":
+        """Create a new write queue. Must be called from the IOLoop thread."""
+        return WriteQueue(self)
+
+    def _enqueued(self, size):
+        with self._lock:
+            self.queued_bytes += size
+
+    def _written(self, size, elapsed):
+        with self._lock:
+            self.queued_bytes -= size
+            self.writes += 1
+            self.write_time += elapsed
+            if elapsed > self.max_write_time:
+                self.max_write_time = elapsed
+        WRITE_LATENCY.observe(elapsed)
+
+    def _dropped(self, size):
+        with self._lock:
+            self.queued_bytes -= size
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "queued_bytes": self.queued_bytes,
+                "writes": self.writes,
+                "write_time": self.write_time,
+                "max_write_time": self.max_write_time,
+            }
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+
+class WriteQueue(object):
+    """Ordered queue of disk operations for a single upload.
+
+    Operations are submitted from the IOLoop thread and executed by the threads of a DiskWriter. When an
+    operation fails, the remaining operations are skipped (except the ones submitted with always=True), and the
+    error is raised from the next submit() or join() call.
+    """
+
+    def __init__(self, disk_writer: DiskWriter):
+        self.disk_writer = disk_writer
+        self.limit = disk_writer.queue_size
+        self.batch_size = min(disk_writer.batch_size, self.limit // 2)
+        self.low_water = self.limit // 2  # Reading from the connection is resumed below this many queued bytes
+        self.io_loop = IOLoop.current()
+        self._lock = threading.Lock()
+        self._ops = deque()
+        self._running = False
+        self._error = None
+        self._space_future = None
+        self._idle_future = None
+        self.queued_bytes = 0  # Bytes waiting in this queue
+        self.max_queued_bytes = 0  # High-water mark of queued_bytes
+        self.writes = 0  # Number of write operations executed
+        self.write_time = 0.0  # Time spent in write operations, in seconds
+
+    def _raise_error(self):
+        if isinstance(self._error, AbortRequest):
+            raise self._error
+        raise AbortRequest(500, "Server error - could not write the uploaded file.") from self._error
+
+    def submit(self, fn, *args, size=0, always=False):
+        """Queue an operation.
+
+        :param fn: The function to be called from a writer thread.
+        :param args: Arguments for fn.
+        :param size: Number of bytes written by the operation. Used for accounting and flow control.
+        :param always: Execute the operation even if a previous operation has failed. Use it for cleanup.
+        """
+        if self._error is not None and not always:
+            self._raise_error()
+        if self.disk_writer.executor is None:
+            if size:
+                self.disk_writer._enqueued(size)
+            elapsed = self._execute(fn, args, size, always)
+            if size:
+                self.writes += 1
+                self.write_time += elapsed
+            if self._error is not None and not always:
+                self._raise_error()
+            return
+        with self._lock:
+            self._ops.append((fn, args, size, always))
+            self.queued_bytes += size
+            if self.queued_bytes > self.max_queued_bytes:
+                self.max_queued_bytes = self.queued_bytes
+            # Data is handed over to the writer thread in batches, waking up a thread for every chunk is expensive.
+            start = not self._running and (not size or self.queued_bytes >= self.batch_size)
+            if start:
+                self._running = True
+        if size:
+            self.disk_writer._enqueued(size)
+        if start:
+            self.disk_writer.executor.submit(self._run)
+
+    def cancel(self):
+        """Drop all pending operations that were not submitted with always=True."""
+        with self._lock:
+            kept = deque(op for op in self._ops if op[3])
+            dropped = sum(op[2] for op in self._ops if not op[3])
+            self._ops = kept
+            self.queued_bytes -= dropped
+        if dropped:
+            self.disk_writer._dropped(dropped)
+        self._wake_up()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._ops:
+                    self._running = False
+                    wake_up = self._idle_future is not None or self._space_future is not None
+                    break
+                fn, args, size, always = self._ops.popleft()
+            elapsed = self._execute(fn, args, size, always)
+            with self._lock:
+                self.queued_bytes -= size
+                if size:
+                    self.writes += 1
+                    self.write_time += elapsed
+                wake_up = self._space_future is not None and (
+                    self.queued_bytes <= self.low_water or self._error is not None)
+            if wake_up:
+                self.io_loop.add_callback(self._wake_up)
+        if wake_up:
+            self.io_loop.add_callback(self._wake_up)
+
+    def _execute(self, fn, args, size, always):
+        started = time.perf_counter()
+        if self._error is None or always:
+            try:
+                fn(*args)
+            except BaseException as e:
+                if self._error is None:
+                    self._error = e
+        elapsed = time.perf_counter() - started
+        if size:
+            self.disk_writer._written(size, elapsed)
+        return elapsed
+
+    def _wake_up(self):
+        """Resolve the waiting futures. Called on the IOLoop thread."""
+        with self._lock:
+            space_future, idle_future = self._space_future, self._idle_future
+            if space_future is not None and (self.queued_bytes <= self.low_water or self._error is not None):
+                self._space_future = None
+            else:
+                space_future = None
+            if idle_future is not None and not self._running:
+                self._idle_future = None
+            else:
+                idle_future = None
+        if space_future is not None:
+            future_set_result_unless_cancelled(space_future, None)
+        if idle_future is not None:
+            future_set_result_unless_cancelled(idle_future, None)
+
+    def wait_for_space(self):
+        """Return a future that is resolved when the queue has drained below its low water mark, or None when the
+        queue is not full."""
+        with self._lock:
+            if self.queued_bytes < self.limit or self._error is not None:
+                return None
+            if self._space_future is None:
+                self._space_future = Future()
+            return self._space_future
+
+    async def join(self):
+        """Wait until all queued operations are executed, raise an AbortRequest when one of them has failed."""
+        with self._lock:
+            start = not self._running and bool(self._ops)
+            if start:
+                self._running = True
+            if self._running and self._idle_future is None:
+                self._idle_future = Future()
+            idle_future = self._idle_future
+        if start:
+            self.disk_writer.executor.submit(self._run)
+        if idle_future is not None:
+            await idle_future
+        if self._error is not None:
+            self._raise_error()
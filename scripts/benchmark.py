@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""Benchmark the upload streamers of the server.
+
+This feeds generated data directly into the streamers, in chunks of the same size that tornado uses, so it
+measures the CPU and disk cost of the upload path without any network overhead. The parser and parser-legacy
+benchmarks discard the parsed data, so they measure the multipart parsers alone.
+
+The multipart parser of the server is checked against the parser of tornadostreamform by tests/test_multipart.py.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from types import SimpleNamespace
+
+from tornado.ioloop import IOLoop
+from tornadostreamform.multipart_streamer import MultiPartStreamer, StreamedPart
+
+from dropzone_backup_server.const import MB
+from dropzone_backup_server.multipart import ZeroCopyMultiPartStreamer
+from dropzone_backup_server.server import DropFileStreamer, RawFileStreamer
+from dropzone_backup_server.staging import StagingArea
+from dropzone_backup_server.writer import DiskWriter
+
+CHUNK_SIZE = 64 * 1024  # Default chunk size of tornado's HTTP1Connection
+BOUNDARY = b"----dzbenchmarkboundary"
+
+
+def make_config(upload_dir, disk_writer, checksum="none", write_buffer_size=1 * MB, preallocate=True):
+    return SimpleNamespace(
+        tmp_suffix=".~tmp", overwrite=True, auto_create_user_dir=True, verbose=False, debug=False,
+        upload_base_dir=upload_dir, disk_writer=disk_writer, checksum=checksum, checksum_sidecar=False,
+        dedup_store=None, usage_index=None, write_buffer_size=write_buffer_size, preallocate=preallocate,
+        durability="none", group_committer=None, staging=StagingArea(),
+    )
+
+
+def get_write_syscalls():
+    """Number of write system calls of the process, or None when not available (Linux only)."""
+    try:
+        with open("/proc/self/io") as fin:
+            for line in fin:
+                if line.startswith("syscw:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class LegacyDropFileStreamer(MultiPartStreamer):
+    """DropFileStreamer with the multipart parser of tornadostreamform, for comparison."""
+
+    def __init__(self, upload_dir, total, config):
+        super().__init__(total)
+        self.upload_dir = upload_dir
+        self.config = config
+        self.write_queue = config.disk_writer.open_queue()
+        self.remaining = total
+        self.compression = None
+        self.username = None
+
+    create_part = DropFileStreamer.create_part
+
+    def release_parts(self):
+        self.write_queue.cancel()
+        super().release_parts()
+
+
+class NullPart(StreamedPart):
+    """Part that discards its data. The streamers count its size."""
+
+    def feed(self, data):
+        pass
+
+
+class NullStreamer(ZeroCopyMultiPartStreamer):
+    def create_part(self, headers):
+        return NullPart(self, headers)
+
+
+class LegacyNullStreamer(MultiPartStreamer):
+    def create_part(self, headers):
+        return NullPart(self, headers)
+
+
+def multipart_body(payload, filename):
+    head = b"--" + BOUNDARY + b"\r\n" + \
+        b'Content-Disposition: form-data; name="file"; filename="' + filename.encode() + b'"\r\n' + \
+        b"Content-Type: application/octet-stream\r\n\r\n"
+    tail = b"\r\n--" + BOUNDARY + b"--\r\n"
+    return head + payload + tail
+
+
+async def feed(streamer, body, chunk_size):
+    """Feed the body into the streamer the same way as DropFileHandler does."""
+    view = memoryview(body)
+    try:
+        for pos in range(0, len(body), chunk_size):
+            streamer.data_received(bytes(view[pos:pos + chunk_size]))
+            wait = streamer.write_queue.wait_for_space()
+            if wait is not None:
+                await wait
+        streamer.data_complete()
+        await streamer.write_queue.join()
+    finally:
+        streamer.release_parts()
+        await streamer.write_queue.join()
+
+
+async def bench_multipart(upload_dir, payload, chunk_size, config):
+    body = multipart_body(payload, "multipart.bin")
+    started = time.perf_counter(), time.process_time()
+    await feed(DropFileStreamer(upload_dir, len(body), config), body, chunk_size)
+    return time.perf_counter() - started[0], time.process_time() - started[1]
+
+
+async def bench_multipart_legacy(upload_dir, payload, chunk_size, config):
+    body = multipart_body(payload, "multipart.bin")
+    started = time.perf_counter(), time.process_time()
+    await feed(LegacyDropFileStreamer(upload_dir, len(body), config), body, chunk_size)
+    return time.perf_counter() - started[0], time.process_time() - started[1]
+
+
+def parse(streamer, body, chunk_size):
+    # Chunks are created in advance, so only the parser is measured.
+    chunks = [body[pos:pos + chunk_size] for pos in range(0, len(body), chunk_size)]
+    started = time.perf_counter(), time.process_time()
+    for chunk in chunks:
+        streamer.data_received(chunk)
+    streamer.data_complete()
+    elapsed = time.perf_counter() - started[0], time.process_time() - started[1]
+    assert streamer.parts[0].size == len(body) - len(multipart_body(b"", "parser.bin"))
+    return elapsed
+
+
+async def bench_parser(upload_dir, payload, chunk_size, config):
+    body = multipart_body(payload, "parser.bin")
+    return parse(NullStreamer(len(body)), body, chunk_size)
+
+
+async def bench_parser_legacy(upload_dir, payload, chunk_size, config):
+    body = multipart_body(payload, "parser.bin")
+    return parse(LegacyNullStreamer(len(body)), body, chunk_size)
+
+
+async def bench_raw(upload_dir, payload, chunk_size, config):
+    started = time.perf_counter(), time.process_time()
+    await feed(RawFileStreamer(upload_dir, "raw.bin", len(payload), config), payload, chunk_size)
+    return time.perf_counter() - started[0], time.process_time() - started[1]
+
+
+BENCHMARKS = {
+    "parser": bench_parser,
+    "parser-legacy": bench_parser_legacy,
+    "multipart": bench_multipart,
+    "multipart-legacy": bench_multipart_legacy,
+    "raw": bench_raw,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the upload streamers of Dropzone-Backup Server")
+    parser.add_argument("-s", "--size", dest="size", type=int, default=256, help="Upload size in MB. Default: 256")
+    parser.add_argument("-c", "--chunk-size", dest="chunk_size", type=int, default=CHUNK_SIZE,
+                        help="Size of chunks fed into the streamers. Default: %d" % CHUNK_SIZE)
+    parser.add_argument("-r", "--repeat", dest="repeat", type=int, default=3,
+                        help="Number of runs, the best one is reported. Default: 3")
+    parser.add_argument("--dir", dest="dir", default=None, help="Directory for the uploaded files.")
+    parser.add_argument("--writer-threads", dest="writer_threads", type=int, default=4,
+                        help="Number of disk writer threads. Default: 4")
+    parser.add_argument("--write-queue-size", dest="write_queue_size", type=int, default=4 * MB,
+                        help="Max. bytes queued for the disk writer. Default: 4MB")
+    parser.add_argument("--write-buffer-size", dest="write_buffer_size", type=int, default=1 * MB,
+                        help="Received data is written in blocks of this many bytes. Zero writes every chunk "
+                             "separately. Default: 1MB")
+    parser.add_argument("--no-preallocate", dest="preallocate", action="store_false", default=True,
+                        help="Do not preallocate disk space for the uploaded files.")
+    parser.add_argument("--checksum", dest="checksum", choices=["none", "sha256", "blake2b"], default="none",
+                        help="Compute checksums while uploading. Default: none")
+    args = parser.parse_args()
+
+    payload = os.urandom(args.size * MB)
+    upload_dir = tempfile.mkdtemp(prefix="dzbench-", dir=args.dir)
+    disk_writer = DiskWriter(args.writer_threads, args.write_queue_size)
+    config = make_config(upload_dir, disk_writer, args.checksum, args.write_buffer_size, args.preallocate)
+    try:
+        for name, bench in BENCHMARKS.items():
+            runs = []
+            for _ in range(args.repeat):
+                syscalls = get_write_syscalls()
+                elapsed, cpu = IOLoop.current().run_sync(lambda: bench(upload_dir, payload, args.chunk_size, config))
+                if syscalls is not None:
+                    syscalls = get_write_syscalls() - syscalls
+                runs.append((elapsed, cpu, syscalls))
+            elapsed, cpu, syscalls = min(runs)
+            print("%-16s %8.1f MB/s  %6.2f CPU s/GB  %8s write syscalls" % (
+                name, args.size / elapsed, cpu * 1024 / args.size, "-" if syscalls is None else syscalls))
+    finally:
+        disk_writer.shutdown()
+        shutil.rmtree(upload_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,19 @@
+import sys
+import csv
+import logging
 import argparse
 import getpass
 from dropzone_backup_server.const import *
 from dropzone_backup_server.server import main
-from dropzone_backup_server.security import SecurityManager
+from dropzone_backup_server.error import AbortRequest
+from dropzone_backup_server.security import SecurityManager, USER_OPTIONS, parse_size, format_size, get_upload_dir
+from dropzone_backup_server.client import RangeUploader, UploadError
+from dropzone_backup_server.dedup import DedupStore
+from dropzone_backup_server.usage import UsageIndex, USAGE_DB_NAME
+from dropzone_backup_server.compression import parse_compression
 
 MAX_STREAMED_SIZE = 1 * TB  # Max. size streamed in one request
-VALID_ACTIONS = ["serve", "adduser", "deluser"]
+VALID_ACTIONS = ["serve", "adduser", "deluser", "import-users", "export-users", "upload", "dedup-gc", "usage"]
 
 parser = argparse.ArgumentParser(description='Dropzone-Backup Server')
 
@@ -22,6 +30,15 @@ parser.add_argument("-m", "--max-file-size", dest='max_file_size', metavar="MAX_
                     type=int, default=MAX_STREAMED_SIZE,
                     help="Maximum file size to be accepted. Defaults to 1*TB"
                     )
+parser.add_argument("-w", "--workers", dest='workers', metavar="WORKERS",
+                    type=int, default=1,
+                    help="Number of worker processes. When greater than one, the server forks worker processes "
+                         "that accept connections on a shared socket (Unix only). Default is 1."
+                    )
+parser.add_argument("--shutdown-timeout", dest='shutdown_timeout', metavar="SECONDS",
+                    type=float, default=60.0,
+                    help="On SIGTERM, wait this many seconds for in-flight uploads to finish. Default is 60."
+                    )
 parser.add_argument("--pidfile", dest='pid_file_path', metavar="PIDFILE",
                     default="dropzone-backup-server.pid",
                     help="Filename where the pid of the process should be written."
@@ -54,24 +71,161 @@ parser.add_argument("--tmp-suffix", dest='tmp_suffix', metavar="TMP_SUFFIX",
 parser.add_argument("--overwrite", dest='overwrite', default=False, action="store_true",
                     help="Allow overwrite files."
                     )
+parser.add_argument("--auth-workers", dest='auth_workers', metavar="AUTH_WORKERS",
+                    type=int, default=None,
+                    help="Number of threads verifying password hashes. This is the maximum number of concurrent "
+                         "password checks, further requests wait in a queue. Defaults to the number of CPU cores."
+                    )
+parser.add_argument("--writer-threads", dest='writer_threads', metavar="WRITER_THREADS",
+                    type=int, default=4,
+                    help="Number of threads writing uploaded data to the disk. Default is 4."
+                    )
+parser.add_argument("--write-queue-size", dest='write_queue_size', metavar="WRITE_QUEUE_SIZE",
+                    type=int, default=4 * MB,
+                    help="Max. number of bytes waiting to be written to the disk for a single upload. When "
+                         "exceeded, the server stops reading from the connection until the disk catches up. "
+                         "Default is 4MB."
+                    )
+parser.add_argument("--write-buffer-size", dest='write_buffer_size', metavar="WRITE_BUFFER_SIZE",
+                    type=parse_size, default=1 * MB,
+                    help="Received data is collected and written to the disk in blocks of this many bytes, with "
+                         "a single system call. Zero writes every received chunk separately. Default is 1M."
+                    )
+parser.add_argument("--no-preallocate", dest='preallocate', action="store_false", default=True,
+                    help="Do not preallocate disk space for uploaded files. By default, the space is allocated "
+                         "when the upload starts (using Content-Length), so files are less fragmented."
+                    )
+parser.add_argument("--durability", dest='durability', metavar="LEVEL",
+                    choices=["none", "per-file", "group"], default="none",
+                    help="How uploaded files are flushed to the disk before the response is sent. none: never, a "
+                         "crash can leave empty or partial files behind. per-file: the file and its directory are "
+                         "synced one by one. group: concurrent uploads are synced together by a background "
+                         "thread, which is much faster for many small files. Default is none."
+                    )
+parser.add_argument("--session-ttl", dest='session_ttl', metavar="SECONDS",
+                    type=float, default=7 * 24 * 3600,
+                    help="Resumable upload sessions that were not written for this many seconds are deleted. "
+                         "Default is 7 days."
+                    )
+parser.add_argument("--checksum", dest='checksum', metavar="ALGORITHM",
+                    choices=["none", "sha256", "blake2b"], default="none",
+                    help="Compute the checksum of every uploaded file while it is streamed, and return it in the "
+                         "response. Can be none, sha256 or blake2b. Default is none. Checksums sent by the clients "
+                         "in the Upload-Checksum header are always verified."
+                    )
+parser.add_argument("--checksum-sidecar", dest='checksum_sidecar', action="store_true", default=False,
+                    help="Write the checksum of uploaded files into <filename>.<algorithm> files."
+                    )
+parser.add_argument("--dedup-dir", dest='dedup_dir', metavar="DEDUP_DIR",
+                    default=None,
+                    help="Enable deduplication: files with the same content are stored only once, in this "
+                         "directory, and uploaded files are hard links to them. It must be on the same file system "
+                         "as the upload directories. When relative path is given, then it is relative to "
+                         "--upload-base-dir. Use the dedup-gc action to delete unreferenced files."
+                    )
+parser.add_argument("--metrics", dest='metrics', action="store_true", default=False,
+                    help="Export metrics in the Prometheus text format at /metrics. They may contain user names, so "
+                         "do not expose them to the public. With multiple workers, use --metrics-port instead."
+                    )
+parser.add_argument("--metrics-port", dest='metrics_port', metavar="METRICS_PORT",
+                    type=int, default=None,
+                    help="Export metrics at /metrics on a separate port, instead of the main port. Every worker "
+                         "listens on its own port: METRICS_PORT + worker id (starting from zero)."
+                    )
+parser.add_argument("--usage-db", dest='usage_db', metavar="USAGE_DB",
+                    default=USAGE_DB_NAME,
+                    help="Index of the disk usage of the upload directories, used for checking quotas. It is "
+                         "rebuilt when the server starts, and updated when files are uploaded. When relative path "
+                         "is given, then it is relative to --upload-base-dir. Default is %s" % USAGE_DB_NAME
+                    )
+parser.add_argument("--usage-scan-threads", dest='usage_scan_threads', metavar="THREADS",
+                    type=int, default=16,
+                    help="Number of threads scanning the upload directories when the usage index is rebuilt. "
+                         "Default is 16."
+                    )
+parser.add_argument("--rescan", dest='rescan', action="store_true", default=False,
+                    help="Rebuild the usage index before reporting it (for the usage action). Uploads that are "
+                         "committed while scanning may be miscounted until the server is restarted."
+                    )
+parser.add_argument("--token-ttl", dest='token_ttl', metavar="SECONDS",
+                    type=float, default=3600,
+                    help="Clients can exchange their password for an upload token at /token, that is valid for this "
+                         "many seconds. Tokens are checked much faster than passwords. Zero disables tokens. "
+                         "Default is 3600."
+                    )
+parser.add_argument("--token-secret-file", dest='token_secret_file', metavar="TOKEN_SECRET_FILE",
+                    default=None,
+                    help="File of the secret key that signs upload tokens. It is created when it does not exist. "
+                         "When not given, a new key is generated at every start, so tokens are not valid after a "
+                         "restart."
+                    )
 parser.add_argument("--passwdfile", dest='passwdfile', metavar="PASSWD_FILE",
                     default="passwd",
-                    help="Passwd file for authenticating users"
+                    help="Passwd file for authenticating users. When it has a .sqlite, .sqlite3 or .db extension, "
+                         "users are stored in an SQLite database instead of a text file. Use the import-users and "
+                         "export-users actions to convert between them."
                     )
 parser.add_argument("-u", "--username", dest='username', metavar="USER_NAME",
                     default=None, help="Username  (for adding/updating users).")
 parser.add_argument("--password", dest='password', metavar="PASSWORD",
                     default=None, help="Password  (for adding/updating users).")
+parser.add_argument("--max-uploads", dest='max_uploads', metavar="MAX_UPLOADS",
+                    type=int, default=None,
+                    help="Max. number of concurrent uploads of the user (for adding/updating users). "
+                         "Zero means unlimited.")
+parser.add_argument("--max-rate", dest='max_rate', metavar="MAX_RATE",
+                    type=parse_size, default=None,
+                    help="Max. upload bandwidth of the user in bytes per second, with optional K, M or G suffix, "
+                         "e.g. 10M (for adding/updating users). Zero means unlimited.")
+parser.add_argument("--quota", dest='quota', metavar="QUOTA",
+                    type=parse_size, default=None,
+                    help="Max. total size of the files in the upload directory of the user, with optional K, M, G "
+                         "or T suffix, e.g. 500G (for adding/updating users). Zero means unlimited.")
+parser.add_argument("--compress", dest='compress', choices=["none", "gzip", "zstd"],
+                    default=None,
+                    help="Compress the files uploaded by the user, and add the .gz or .zst extension to their names "
+                         "(for adding/updating users). zstd needs the zstandard package.")
+parser.add_argument("--csv", dest='csv', metavar="CSV_FILE",
+                    default=None,
+                    help="Add or update many users from a CSV file (for adding/updating users). The first row must "
+                         "contain the column names: username, password, prefix and optionally %s. Passwords are "
+                         "hashed in parallel." % ", ".join(sorted(USER_OPTIONS)))
 parser.add_argument("--prefix", dest='prefix', metavar="PREFIX",
                     default="",
                     help="Prefix dir (for adding/updating users). When relative path is specified, then it is "
                          "relative to --upload-base dir.")
 
+parser.add_argument("--url", dest='url', metavar="URL",
+                    default="http://localhost:8888",
+                    help="Base url of the server (for uploading files). Default is http://localhost:8888")
+parser.add_argument("-f", "--file", dest='file', metavar="FILE",
+                    default=None, help="File to be uploaded (for uploading files), or the passwd file to import "
+                                       "from / export to (for import-users and export-users).")
+parser.add_argument("-c", "--connections", dest='connections', metavar="CONNECTIONS",
+                    type=int, default=4,
+                    help="Number of parallel connections (for uploading files). Default is 4.")
+parser.add_argument("--part-size", dest='part_size', metavar="PART_SIZE",
+                    type=int, default=64 * MB,
+                    help="Files are uploaded in parts of this many bytes (for uploading files). Default is 64MB.")
+
 parser.add_argument("--auto-create-user-dirs", dest='auto_create_user_dir', action="store_true", default=False,
                     help="Automatically create user upload directories if they don't exist. (Can be dangerous"
                          " when absolute upload dirs are specified!)"
                     )
 
+parser.add_argument("--log-file", dest='log_file', metavar="LOG_FILE",
+                    default=None,
+                    help="Write the log to this file instead of stderr. It is reopened when it has been rotated "
+                         "(e.g. by logrotate)."
+                    )
+parser.add_argument("--no-access-log", dest='access_log', action="store_false", default=True,
+                    help="Do not log a line for every request."
+                    )
+parser.add_argument("--trace-sample-rate", dest='trace_sample_rate', metavar="RATE",
+                    type=float, default=0.0,
+                    help="Log the chunks of uploads received, with this probability between 0 and 1. "
+                         "Default is 0 (no trace)."
+                    )
 parser.add_argument("-v", "--verbose", dest='verbose', action="store_true", default=False,
                     help="Change log level from WARNING to INFO."
                     )
@@ -83,6 +237,10 @@ args = parser.parse_args()
 
 if args.action not in VALID_ACTIONS:
     parser.error("Invalid action, must be in: %s" % VALID_ACTIONS)
+if not 0 <= args.trace_sample_rate <= 1:
+    parser.error("--trace-sample-rate must be between 0 and 1.")
+if args.action != "serve":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
 
 security_manager = SecurityManager(args.passwdfile)
 
@@ -91,16 +249,98 @@ if args.action == "adduser":
         with open(args.passwdfile, "w+") as fout:
             pass
 
+    if args.csv:
+        rows = []
+        with open(args.csv, newline="") as fin:
+            for row in csv.DictReader(fin):
+                options = {}
+                for name, (parse, _) in USER_OPTIONS.items():
+                    if (row.get(name, None) or "").strip():
+                        options[name] = parse(row[name])
+                rows.append(dict(login=row["username"], password=row.get("password", None),
+                                 prefix=row.get("prefix", None) or "", perms="W", options=options))
+        try:
+            count = security_manager.save_users(rows)
+        except AbortRequest as e:
+            sys.stderr.write("%s\n" % e.message)
+            sys.exit(1)
+        print("Saved %d users." % count)
+        sys.exit(0)
+
     username = args.username
     password = args.password
     if not username:
-        parser.error("You must specify --username for the adduser action.")
+        parser.error("You must specify --username or --csv for the adduser action.")
     if password is None:
         password = getpass.getpass("Password:")
     if not password:
         parser.error("Invalid empty password.")
     perms = "W"
-    security_manager.save_user(username, args.prefix, perms, password)
+    options = {}
+    if args.max_uploads is not None:
+        options["max_uploads"] = args.max_uploads
+    if args.max_rate is not None:
+        options["max_rate"] = args.max_rate
+    if args.quota is not None:
+        options["quota"] = args.quota
+    if args.compress is not None:
+        options["compress"] = parse_compression(args.compress)
+    security_manager.save_user(username, args.prefix, perms, password, options)
+elif args.action in ["import-users", "export-users"]:
+    if not args.file:
+        parser.error("You must specify --file for the %s action." % args.action)
+    if args.action == "import-users":
+        print("Imported %d users." % security_manager.import_users(args.file))
+    else:
+        print("Exported %d users." % security_manager.export_users(args.file))
+elif args.action == "upload":
+    if not args.file:
+        parser.error("You must specify --file for the upload action.")
+    password = args.password
+    if args.username and password is None:
+        password = getpass.getpass("Password:")
+    uploader = RangeUploader(args.url, args.username, password, connections=args.connections,
+                             part_size=args.part_size, verbose=args.verbose or args.debug)
+    try:
+        elapsed = uploader.upload(args.file)
+    except (OSError, UploadError) as e:
+        sys.stderr.write("Upload failed: %s\n" % e)
+        sys.exit(1)
+    size = os.path.getsize(args.file)
+    print("Uploaded %d bytes in %.2f seconds (%.1f MB/s)" % (size, elapsed, size / MB / max(elapsed, 1e-6)))
+elif args.action == "dedup-gc":
+    if not args.dedup_dir:
+        parser.error("You must specify --dedup-dir for the dedup-gc action.")
+    if not args.upload_base_dir and not os.path.isabs(args.dedup_dir):
+        parser.error("--upload-base-dir must be given when --dedup-dir is relative.")
+    dedup_store = DedupStore(os.path.join(args.upload_base_dir or "", args.dedup_dir))
+    result = dedup_store.collect_garbage()
+    print("Deleted %d unreferenced blobs, freed %.1f MB." % (result["deleted_blobs"], result["freed_bytes"] / MB))
+    print("%d blobs are referenced by %d files, %.1f MB stored, %.1f MB saved by deduplication." % (
+        result["blobs"], result["files"], result["stored_bytes"] / MB, result["saved_bytes"] / MB))
+    print("%.1f MB saved in total since the blobs were stored." % (result["total_saved_bytes"] / MB))
+elif args.action == "usage":
+    if not args.upload_base_dir:
+        parser.error("--upload-base-dir must be given for the usage action.")
+    usage_index = UsageIndex(os.path.join(args.upload_base_dir, args.usage_db))
+    upload_dirs = {}  # Upload dir -> list of (user name, quota)
+    for user in security_manager.get_users().values():
+        upload_dir = os.path.abspath(get_upload_dir(args.upload_base_dir, user["prefix"]))
+        upload_dirs.setdefault(upload_dir, []).append((user["name"], user["options"].get("quota", 0)))
+    if args.anonymous_dir:
+        upload_dirs.setdefault(os.path.abspath(get_upload_dir(args.upload_base_dir, args.anonymous_dir)),
+                               []).append(("(anonymous)", 0))
+    if args.rescan:
+        exclude = [os.path.join(args.upload_base_dir, args.dedup_dir)] if args.dedup_dir else []
+        usage_index.rebuild(upload_dirs, args.tmp_suffix, exclude, args.usage_scan_threads)
+    usage = usage_index.get_all()
+    print("%-20s %12s %10s %10s %6s  %s" % ("USER", "SIZE (MB)", "FILES", "QUOTA", "USED", "DIRECTORY"))
+    for upload_dir, users in sorted(upload_dirs.items()):
+        size, files = usage.get(upload_dir, (0, 0))
+        for username, quota in sorted(users):
+            print("%-20s %12.1f %10d %10s %6s  %s" % (
+                username, size / MB, files, format_size(quota) if quota else "-",
+                "%.0f%%" % (size * 100 / quota) if quota else "-", upload_dir))
 elif args.action == "deluser":
     username = args.username
     if not username:
@@ -109,6 +349,11 @@ elif args.action == "deluser":
 else:
     if not args.upload_base_dir:
         parser.error("--upload-base-dir must be given.")
+    if args.workers < 1:
+        parser.error("--workers must be a positive number.")
+    if args.workers > 1 and not hasattr(os, "fork"):
+        parser.error("--workers is not supported on this platform.")
 
+    args.usage_db = os.path.join(args.upload_base_dir, args.usage_db)
     args.security_manager = security_manager
     main(args)
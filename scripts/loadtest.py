@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""Load test the upload path of a local server.
+
+This starts a server in a subprocess, with a temporary upload base dir and a generated passwd file, and runs
+concurrent clients against it: multipart and raw uploads, authenticated and anonymous, with the given file sizes.
+It reports throughput, request latency percentiles, CPU time per GB and the peak RSS of the server processes.
+
+The results are written in JSON, so they can be compared across commits. CPU and memory figures are read from
+/proc, so this runs on Linux only. Everything runs on the local machine, no network access is needed.
+"""
+import argparse
+import contextlib
+import http.client
+import itertools
+import json
+import os
+import platform
+import secrets
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dropzone_backup_server.const import MB, GB
+from dropzone_backup_server.security import SecurityManager, parse_size, format_size
+
+MY_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(MY_DIR)
+BOUNDARY = "----dzloadtestboundary"
+PAYLOAD_SIZE = 1 * MB  # Uploads send this buffer over and over again
+USERNAME = "bench"
+ANONYMOUS_DIR = "anon"
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class ServerProcess(object):
+    """A server running in a subprocess, with its own temporary directories."""
+
+    def __init__(self, base_dir, port, server_args):
+        self.base_dir = base_dir
+        self.port = port
+        self.upload_base_dir = os.path.join(base_dir, "upload")
+        self.passwdfile = os.path.join(base_dir, "passwd")
+        self.password = secrets.token_hex(8)
+        os.makedirs(os.path.join(self.upload_base_dir, ANONYMOUS_DIR))
+        os.makedirs(os.path.join(self.upload_base_dir, USERNAME))
+        open(self.passwdfile, "w").close()
+        with contextlib.redirect_stdout(sys.stderr):  # Keep the standard output clean for the results
+            SecurityManager(self.passwdfile).save_user(USERNAME, USERNAME, "W", self.password)
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [REPO_DIR, env.get("PYTHONPATH")]))
+        self.log = open(os.path.join(base_dir, "server.log"), "w+")
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(MY_DIR, "dzbackup.py"), "serve", "--listen", "127.0.0.1",
+             "--port", str(port), "--upload-base-dir", self.upload_base_dir, "--anonymous-dir", ANONYMOUS_DIR,
+             "--passwdfile", self.passwdfile, "--pidfile", os.path.join(base_dir, "dzbackup.pid"),
+             "--usage-db", os.path.join(base_dir, "usage.sqlite"), "--overwrite"] + server_args,
+            env=env, stdout=self.log, stderr=subprocess.STDOUT)
+
+    def wait_until_ready(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("The server has exited, see %s" % self.log.name)
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError("The server did not start in %d seconds" % timeout)
+
+    def get_pids(self):
+        """The pid of the server and its worker processes."""
+        pids = [self.process.pid]
+        for name in os.listdir("/proc"):
+            if name.isdigit():
+                try:
+                    with open("/proc/%s/stat" % name) as fin:
+                        if int(fin.read().rsplit(")", 1)[1].split()[1]) == self.process.pid:
+                            pids.append(int(name))
+                except (OSError, IndexError, ValueError):
+                    pass
+        return pids
+
+    def get_cpu_seconds(self):
+        total = 0
+        for pid in self.get_pids():
+            try:
+                with open("/proc/%d/stat" % pid) as fin:
+                    fields = fin.read().rsplit(")", 1)[1].split()
+                total += int(fields[11]) + int(fields[12])  # utime and stime
+            except (OSError, IndexError, ValueError):
+                pass
+        return total / os.sysconf("SC_CLK_TCK")
+
+    def get_peak_rss_kb(self):
+        """The largest peak resident set size of the server processes."""
+        peak = 0
+        for pid in self.get_pids():
+            try:
+                with open("/proc/%d/status" % pid) as fin:
+                    for line in fin:
+                        if line.startswith("VmHWM:"):
+                            peak = max(peak, int(line.split()[1]))
+            except (OSError, IndexError, ValueError):
+                pass
+        return peak
+
+    def stop(self):
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.log.close()
+
+
+def upload(port, mode, size, filename, headers, payload):
+    """Upload a file of generated data, return the HTTP status."""
+    view = memoryview(payload)
+    headers = dict(headers)
+    if mode == "raw":
+        method, path, head, tail = "PUT", "/upload/" + filename, b"", b""
+    else:
+        method, path = "POST", "/upload"
+        head = ("--%s\r\nContent-Disposition: form-data; name=\"file\"; filename=\"%s\"\r\n"
+                "Content-Type: application/octet-stream\r\n\r\n" % (BOUNDARY, filename)).encode("UTF-8")
+        tail = ("\r\n--%s--\r\n" % BOUNDARY).encode("UTF-8")
+        headers["Content-Type"] = "multipart/form-data; boundary=" + BOUNDARY
+    headers["Content-Length"] = str(len(head) + size + len(tail))
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=600)
+    try:
+        conn.putrequest(method, path)
+        for name, value in headers.items():
+            conn.putheader(name, value)
+        conn.endheaders()
+        conn.send(head)
+        remaining = size
+        while remaining:
+            count = min(len(view), remaining)
+            conn.send(view[:count])
+            remaining -= count
+        conn.send(tail)
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+
+def get_token(port, password):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    try:
+        conn.request("POST", "/token", body=b"", headers={"Username": USERNAME, "Password": password})
+        response = conn.getresponse()
+        body = response.read().decode("UTF-8")
+        if response.status != 200:
+            raise RuntimeError("Cannot get an upload token: %s %s" % (response.status, body))
+        return body
+    finally:
+        conn.close()
+
+
+def run_scenario(server, mode, auth, size, concurrency, requests, payload):
+    if auth == "user":
+        headers = {"Username": USERNAME, "Password": server.password}
+        upload_dir = os.path.join(server.upload_base_dir, USERNAME)
+    elif auth == "token":
+        headers = {"Authorization": "Bearer " + get_token(server.port, server.password)}
+        upload_dir = os.path.join(server.upload_base_dir, USERNAME)
+    else:
+        headers = {}
+        upload_dir = os.path.join(server.upload_base_dir, ANONYMOUS_DIR)
+
+    def request(index):
+        filename = "%s-%s-%s-%d.bin" % (mode, auth, format_size(size), index)
+        started = time.perf_counter()
+        try:
+            status = upload(server.port, mode, size, filename, headers, payload)
+        except (OSError, http.client.HTTPException):
+            status = 0
+        elapsed = time.perf_counter() - started
+        try:
+            os.unlink(os.path.join(upload_dir, filename))  # Do not fill the disk with big uploads
+        except FileNotFoundError:
+            pass
+        return status, elapsed
+
+    cpu_started = server.get_cpu_seconds()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(request, range(requests)))
+    elapsed = time.perf_counter() - started
+    cpu = server.get_cpu_seconds() - cpu_started
+    latencies = [latency for status, latency in results if status == 200]
+    uploaded = size * len(latencies)
+    return {
+        "mode": mode,
+        "auth": auth,
+        "size": size,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": requests - len(latencies),
+        "bytes": uploaded,
+        "elapsed": elapsed,
+        "mb_per_s": uploaded / MB / elapsed,
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p99": percentile(latencies, 0.99),
+        "server_cpu_seconds": cpu,
+        "server_cpu_s_per_gb": cpu * GB / uploaded if uploaded else None,
+        "server_peak_rss_kb": server.get_peak_rss_kb(),
+    }
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the upload path of Dropzone-Backup Server")
+    parser.add_argument("-s", "--sizes", dest="sizes", default="64K,1M,64M",
+                        help="Comma separated list of file sizes, with K, M or G suffix. Default: 64K,1M,64M")
+    parser.add_argument("-c", "--concurrency", dest="concurrency", default="1,8",
+                        help="Comma separated list of the numbers of concurrent clients. Default: 1,8")
+    parser.add_argument("-n", "--requests", dest="requests", type=int, default=16,
+                        help="Number of uploads in every scenario. Default: 16")
+    parser.add_argument("--modes", dest="modes", default="multipart,raw",
+                        help="Comma separated list of upload modes: multipart, raw. Default: multipart,raw")
+    parser.add_argument("--auth", dest="auth", default="anonymous,user",
+                        help="Comma separated list of authentication modes: anonymous, user (password), token "
+                             "(upload token). Default: anonymous,user")
+    parser.add_argument("--server-args", dest="server_args", default="",
+                        help="Extra arguments for the server, e.g. \"--workers 4 --writer-threads 0\".")
+    parser.add_argument("--dir", dest="dir", default=None,
+                        help="Directory for the temporary files of the server. Default is the system temp dir.")
+    parser.add_argument("-o", "--output", dest="output", default=None,
+                        help="Write the JSON results into this file instead of the standard output.")
+    args = parser.parse_args()
+
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    concurrencies = [int(value) for value in args.concurrency.split(",")]
+    modes = args.modes.split(",")
+    auths = args.auth.split(",")
+    payload = os.urandom(PAYLOAD_SIZE)
+
+    base_dir = tempfile.mkdtemp(prefix="dzloadtest-", dir=args.dir)
+    server = ServerProcess(base_dir, get_free_port(), shlex.split(args.server_args))
+    results = []
+    try:
+        server.wait_until_ready()
+        for mode, auth, size, concurrency in itertools.product(modes, auths, sizes, concurrencies):
+            result = run_scenario(server, mode, auth, size, concurrency, args.requests, payload)
+            results.append(result)
+            sys.stderr.write("%-9s %-9s %6s x%-3d %9.1f MB/s  p50 %8.1f ms  p99 %8.1f ms  %6s CPU s/GB  "
+                             "%7d KB RSS  %d errors\n" % (
+                                 mode, auth, format_size(size), concurrency, result["mb_per_s"],
+                                 (result["latency_p50"] or 0) * 1000, (result["latency_p99"] or 0) * 1000,
+                                 "-" if result["server_cpu_s_per_gb"] is None else "%.2f" % result["server_cpu_s_per_gb"],
+                                 result["server_peak_rss_kb"], result["errors"]))
+    finally:
+        server.stop()
+        shutil.rmtree(base_dir)
+
+    report = {
+        "commit": get_commit(),
+        "time": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "server_args": args.server_args,
+        "requests": args.requests,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as fout:
+            json.dump(report, fout, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
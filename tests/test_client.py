@@ -0,0 +1,88 @@
+"""Parallel range uploads of RangeUploader against a live server."""
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from dropzone_backup_server.client import RangeUploader, UploadError
+from dropzone_backup_server.security import SecurityManager
+from dropzone_backup_server.sessions import get_session_dir
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USERNAME = "tester"
+PASSWORD = "secret"
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    """A server with two workers and checksums, so the upload requests of a file are processed by different
+    processes, and the "OK" responses are followed by checksum lines."""
+    base_dir = tmp_path_factory.mktemp("server")
+    upload_base_dir = base_dir / "upload"
+    os.makedirs(upload_base_dir / USERNAME)
+    passwdfile = str(base_dir / "passwd")
+    open(passwdfile, "w").close()
+    SecurityManager(passwdfile).save_user(USERNAME, USERNAME, "W", PASSWORD)
+    port = get_free_port()
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [REPO_DIR, env.get("PYTHONPATH")]))
+    with open(base_dir / "server.log", "w+") as log:
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(REPO_DIR, "scripts", "dzbackup.py"), "serve", "--listen", "127.0.0.1",
+             "--port", str(port), "--upload-base-dir", str(upload_base_dir), "--passwdfile", passwdfile,
+             "--pidfile", str(base_dir / "dzbackup.pid"), "--workers", "2", "--checksum", "sha256"],
+            env=env, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            deadline = time.monotonic() + 30
+            while True:
+                assert process.poll() is None, "The server has exited, see %s" % log.name
+                try:
+                    socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                    break
+                except OSError:
+                    assert time.monotonic() < deadline, "The server did not start"
+                    time.sleep(0.1)
+            yield "http://127.0.0.1:%d" % port, str(upload_base_dir / USERNAME)
+        finally:
+            process.terminate()
+            process.wait(30)
+
+
+@pytest.mark.parametrize("size", [0, 1000, 1024 * 1024 + 1])
+def test_upload(server, tmp_path, size):
+    url, upload_dir = server
+    data = os.urandom(size)
+    file_path = tmp_path / ("file-%d.bin" % size)
+    file_path.write_bytes(data)
+    RangeUploader(url, USERNAME, PASSWORD, connections=4, part_size=64 * 1024).upload(str(file_path))
+    with open(os.path.join(upload_dir, file_path.name), "rb") as fin:
+        assert fin.read() == data
+    assert os.listdir(get_session_dir(upload_dir)) == []
+
+
+def test_expired_session(server, tmp_path):
+    url, upload_dir = server
+
+    class ExpiringUploader(RangeUploader):
+        def upload_range(self, session_id, file_path, start, end):
+            # Delete the session like the session reaper does, before the file is uploaded.
+            for name in os.listdir(get_session_dir(upload_dir)):
+                if name.startswith(session_id):
+                    os.unlink(os.path.join(get_session_dir(upload_dir), name))
+            return super().upload_range(session_id, file_path, start, end)
+
+    file_path = tmp_path / "expired.bin"
+    file_path.write_bytes(os.urandom(1000))
+    with pytest.raises(UploadError) as exc_info:
+        ExpiringUploader(url, USERNAME, PASSWORD, retries=0).upload(str(file_path))
+    assert exc_info.value.status == 404
+    assert not os.path.exists(os.path.join(upload_dir, file_path.name))
@@ -0,0 +1,100 @@
+"""Compare the multipart parser of the server with the parser of tornadostreamform, on random forms fed in random
+chunks."""
+import random
+
+import pytest
+from tornadostreamform.multipart_streamer import MultiPartStreamer, StreamedPart
+
+from dropzone_backup_server.error import AbortRequest
+from dropzone_backup_server.multipart import ZeroCopyMultiPartStreamer
+
+FORMS = 500
+
+
+class MemoryPart(StreamedPart):
+    def __init__(self, streamer, headers):
+        super().__init__(streamer, headers)
+        self.data = bytearray()
+        self.finalized = False
+
+    def feed(self, data):
+        self.data += data
+
+    def finalize(self):
+        self.finalized = True
+
+
+class MemoryStreamer(ZeroCopyMultiPartStreamer):
+    def create_part(self, headers):
+        return MemoryPart(self, headers)
+
+
+class LegacyMemoryStreamer(MultiPartStreamer):
+    def create_part(self, headers):
+        return MemoryPart(self, headers)
+
+
+def random_payload(rnd, boundary):
+    """Random data, with fragments that look like the beginning of a boundary."""
+    pieces = []
+    for _ in range(rnd.randint(0, 6)):
+        pieces.append(rnd.randbytes(rnd.choice([0, 1, 10, 1000, 100000])))
+        pieces.append(rnd.choice([b"\r", b"\r\n", b"\r\n-", b"\r\n--", b"\r\n--" + boundary[:rnd.randint(0, len(boundary) - 1)],
+                                  b"\r\n--" + boundary + b"X", b"\r\n\r\n"]))
+    return b"".join(pieces)
+
+
+def random_form(rnd):
+    boundary = b"----dzfuzz" + str(rnd.randint(0, 10 ** 9)).encode()
+    parts, body = [], b""
+    for index in range(rnd.randint(1, 4)):
+        payload = random_payload(rnd, boundary)
+        parts.append(payload)
+        body += b"--" + boundary + b"\r\n"
+        body += b'Content-Disposition: form-data; name="file%d"; filename="f%d.bin"\r\n' % (index, index)
+        if rnd.random() < 0.5:
+            body += b"Content-Type: application/octet-stream\r\n"
+        body += b"\r\n" + payload + b"\r\n"
+    body += b"--" + boundary + b"--\r\n"
+    return body, parts
+
+
+def random_chunks(rnd, body):
+    pos, chunks = 0, []
+    while pos < len(body):
+        size = rnd.choice([1, 2, 3, 7, 50, rnd.randint(1, 200), 4096, 65536])
+        chunks.append(body[pos:pos + size])
+        pos += size
+    return chunks
+
+
+def parse(streamer_class, chunks, total):
+    streamer = streamer_class(total)
+    for chunk in chunks:
+        streamer.data_received(chunk)
+    streamer.data_complete()
+    return [(part.headers, bytes(part.data), part.finalized) for part in streamer.parts]
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_same_result_as_tornadostreamform(seed):
+    rnd = random.Random(seed)
+    for _ in range(FORMS):
+        body, payloads = random_form(rnd)
+        result = parse(MemoryStreamer, random_chunks(rnd, body), len(body))
+        assert result == parse(LegacyMemoryStreamer, [body], len(body))
+        assert [data for headers, data, finalized in result] == payloads
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_corrupted_forms(seed):
+    """Corrupted forms are either parsed or rejected with AbortRequest, never with other errors."""
+    rnd = random.Random(seed)
+    for _ in range(FORMS):
+        garbage = bytearray(random_form(rnd)[0])
+        for _ in range(rnd.randint(1, 10)):
+            garbage[rnd.randrange(len(garbage))] = rnd.choice(b"\r\n-Xa")
+        try:
+            parse(MemoryStreamer, random_chunks(rnd, bytes(garbage)), len(garbage))
+        except AbortRequest:
+            pass
@@ -0,0 +1,29 @@
+"""Users with per-user options in the user stores."""
+import re
+import warnings
+
+import pytest
+
+from dropzone_backup_server.security import SecurityManager
+
+
+@pytest.mark.parametrize("filename", ["passwd", "passwd.sqlite"])
+def test_invalid_options_reject_user(tmp_path, filename):
+    (tmp_path / filename).touch()
+    manager = SecurityManager(str(tmp_path / filename))
+    manager.save_user("limited", "limited", "W", "", {"max_rate": 1024})
+    manager.save_user("other", "other", "W", "")
+    # An option that cannot be parsed, e.g. from a manual edit, or written by a newer version.
+    if filename == "passwd":
+        with open(manager.passwdfile) as fin:
+            content = fin.read()
+        with open(manager.passwdfile, "w") as fout:
+            fout.write(re.sub("max_rate=[^:;]*", "max_rate=fast", content))
+        manager = SecurityManager(manager.passwdfile)
+    else:
+        with manager.store._connect() as conn:
+            conn.execute("UPDATE users SET perms = 'W;max_rate=fast' WHERE name = 'limited'")
+    with warnings.catch_warnings(record=True):
+        warnings.simplefilter("always")
+        assert manager.get_user("limited") is None
+        assert sorted(manager.get_users()) == ["other"]
@@ -0,0 +1,115 @@
+"""Completion of upload sessions that are written by parallel range requests."""
+import os
+from types import SimpleNamespace
+
+import pytest
+from tornado.ioloop import IOLoop
+
+from dropzone_backup_server.const import MB
+from dropzone_backup_server.server import SessionStreamer
+from dropzone_backup_server.sessions import UploadSession, get_session_dir
+from dropzone_backup_server.staging import StagingArea
+from dropzone_backup_server.writer import DiskWriter
+
+PART_SIZE = 256 * 1024
+
+
+@pytest.fixture
+def config(tmp_path):
+    disk_writer = DiskWriter(2, 4 * MB)
+    yield SimpleNamespace(
+        tmp_suffix=".~tmp", overwrite=False, auto_create_user_dir=True, verbose=False, debug=False,
+        upload_base_dir=str(tmp_path), disk_writer=disk_writer, checksum="sha256", checksum_sidecar=False,
+        dedup_store=None, usage_index=None, write_buffer_size=1 * MB, preallocate=True, durability="none",
+        group_committer=None, staging=StagingArea(),
+    )
+    disk_writer.shutdown()
+
+
+class RangeRequest(object):
+    """A PUT request of a session, the same way as SessionHandler processes it."""
+
+    def __init__(self, config, upload_dir, session_id, start, data):
+        self.session = UploadSession.load(upload_dir, session_id)
+        self.session.lock(shared=True)
+        self.session.reload()
+        self.data = data
+        self.streamer = SessionStreamer(self.session, start, start + len(data), len(data), config)
+
+    async def send(self):
+        """Send the body, and wait until the range is saved. The request still holds the session, like a request
+        that is sending its response."""
+        if self.data:
+            self.streamer.data_received(self.data)
+        self.streamer.data_complete()
+        await self.streamer.write_queue.join()
+        return self.streamer.part.is_moved
+
+    async def release(self):
+        """Finish the request, or abort it when the body has not been sent."""
+        self.streamer.release_parts()
+        await self.streamer.write_queue.join()
+
+
+def create_session(upload_dir, data):
+    os.makedirs(upload_dir, exist_ok=True)
+    session = UploadSession.create(upload_dir, "file.bin", len(data))
+    session.preallocate()
+    return session.session_id
+
+
+def assert_committed(upload_dir, data):
+    with open(os.path.join(upload_dir, "file.bin"), "rb") as fin:
+        assert fin.read() == data
+    assert os.listdir(get_session_dir(upload_dir)) == []
+
+
+def test_last_range_commits(config, tmp_path):
+    """The request saving the last range commits the session, while the others have not finished yet."""
+    upload_dir, data = str(tmp_path / "user"), os.urandom(4 * PART_SIZE)
+    session_id = create_session(upload_dir, data)
+
+    async def upload():
+        requests = [RangeRequest(config, upload_dir, session_id, start, data[start:start + PART_SIZE])
+                    for start in range(0, len(data), PART_SIZE)]
+        moved = [await request.send() for request in reversed(requests)]
+        for request in requests:
+            await request.release()
+        return moved
+
+    assert IOLoop.current().run_sync(upload) == [False, False, False, True]
+    assert_committed(upload_dir, data)
+
+
+def test_aborted_request_commits(config, tmp_path):
+    """When a complete session is held by a request that is aborted later, that request commits it."""
+    upload_dir, data = str(tmp_path / "user"), os.urandom(2 * PART_SIZE)
+    session_id = create_session(upload_dir, data)
+
+    async def upload():
+        aborted = RangeRequest(config, upload_dir, session_id, 0, data[:PART_SIZE])
+        complete = RangeRequest(config, upload_dir, session_id, 0, data)
+        moved = await complete.send()
+        await complete.release()
+        await aborted.release()
+        return moved
+
+    assert not IOLoop.current().run_sync(upload)
+    assert_committed(upload_dir, data)
+
+
+def test_incomplete_session_is_not_committed(config, tmp_path):
+    upload_dir, data = str(tmp_path / "user"), os.urandom(2 * PART_SIZE)
+    session_id = create_session(upload_dir, data)
+
+    async def upload():
+        request = RangeRequest(config, upload_dir, session_id, PART_SIZE, data[PART_SIZE:])
+        moved = await request.send()
+        await request.release()
+        return moved
+
+    assert not IOLoop.current().run_sync(upload)
+    assert not os.path.exists(os.path.join(upload_dir, "file.bin"))
+    session = UploadSession.load(upload_dir, session_id)
+    assert session.ranges == [[PART_SIZE, 2 * PART_SIZE]]
+    assert session.get_missing_ranges() == [[0, PART_SIZE]]
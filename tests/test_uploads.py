@@ -0,0 +1,55 @@
+"""Uploads streamed into temporary files and moved to the upload dir."""
+import errno
+import os
+from types import SimpleNamespace
+
+import pytest
+from tornado.ioloop import IOLoop
+
+from dropzone_backup_server import server
+from dropzone_backup_server.const import MB
+from dropzone_backup_server.server import DropFileStreamer
+from dropzone_backup_server.staging import StagingArea
+from dropzone_backup_server.writer import DiskWriter
+
+BOUNDARY = b"----dztestboundary"
+
+
+@pytest.fixture
+def config(tmp_path):
+    disk_writer = DiskWriter(2, 4 * MB)
+    yield SimpleNamespace(
+        tmp_suffix=".~tmp", overwrite=False, auto_create_user_dir=True, verbose=False, debug=False,
+        upload_base_dir=str(tmp_path), disk_writer=disk_writer, checksum="none", checksum_sidecar=False,
+        dedup_store=None, usage_index=None, write_buffer_size=1 * MB, preallocate=True, durability="none",
+        group_committer=None, staging=StagingArea(),
+    )
+    disk_writer.shutdown()
+
+
+async def upload(streamer, body):
+    try:
+        streamer.data_received(body)
+        streamer.data_complete()
+        await streamer.write_queue.join()
+    finally:
+        streamer.release_parts()
+        await streamer.write_queue.join()
+
+
+def test_failed_preallocation_is_truncated(config, tmp_path, monkeypatch):
+    def preallocate(fd, size):
+        # posix_fallocate() can extend the file before it runs out of space.
+        os.ftruncate(fd, size)
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+    monkeypatch.setattr(server, "preallocate", preallocate)
+    upload_dir = str(tmp_path / "user")
+    data = os.urandom(1000)
+    body = b"--" + BOUNDARY + b"\r\n" + \
+        b'Content-Disposition: form-data; name="file"; filename="file.bin"\r\n\r\n' + \
+        data + b"\r\n--" + BOUNDARY + b"--\r\n"
+    # The rest of the body is preallocated for the part, which is more than its data.
+    IOLoop.current().run_sync(lambda: upload(DropFileStreamer(upload_dir, len(body), config), body))
+    with open(os.path.join(upload_dir, "file.bin"), "rb") as fin:
+        assert fin.read() == data
@@ -0,0 +1,60 @@
+"""Usage index of the upload directories, with hard-linked (deduplicated) files."""
+import os
+
+import pytest
+
+from dropzone_backup_server.usage import UsageIndex, USAGE_DB_NAME
+
+
+@pytest.fixture
+def upload_dir(tmp_path):
+    path = tmp_path / "user"
+    os.makedirs(path / "sub")
+    (path / "single.bin").write_bytes(b"x" * 100)
+    (tmp_path / "blob").write_bytes(b"y" * 1000)  # Outside of the upload dir, like the dedup store
+    for name in ["a.bin", "b.bin", "sub/c.bin"]:
+        os.link(tmp_path / "blob", path / name)
+    return str(path)
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = UsageIndex(str(tmp_path / USAGE_DB_NAME))
+    yield index
+    index.close()
+
+
+def test_links_are_counted_once(index, upload_dir):
+    assert index.rebuild([upload_dir], ".~tmp") == {upload_dir: (1100, 4)}
+    assert index.get(upload_dir) == (1100, 4)
+
+
+def test_replace_file(index, upload_dir):
+    index.rebuild([upload_dir], ".~tmp")
+    blob = os.path.join(os.path.dirname(upload_dir), "blob")
+    # Another link to the same content takes no space.
+    os.link(blob, os.path.join(upload_dir, "d.bin"))
+    index.replace_file(upload_dir, None, os.stat(blob))
+    assert index.get(upload_dir) == (1100, 5)
+    # The space is released with the last link.
+    for name in ["a.bin", "b.bin", "sub/c.bin", "d.bin"]:
+        path = os.path.join(upload_dir, name)
+        old_stat = os.stat(path)
+        os.unlink(path)
+        index.replace_file(upload_dir, old_stat, None)
+    assert index.get(upload_dir) == (100, 1)
+    # Overwriting a single file with a bigger one.
+    path = os.path.join(upload_dir, "single.bin")
+    old_stat = os.stat(path)
+    with open(path + ".new", "wb") as fout:
+        fout.write(b"z" * 300)
+    os.replace(path + ".new", path)
+    index.replace_file(upload_dir, old_stat, os.stat(path))
+    assert index.get(upload_dir) == (300, 1)
+    assert index.rebuild([upload_dir], ".~tmp") == {upload_dir: (300, 1)}
+
+
+def test_missing_dir(index, tmp_path):
+    # Upload dirs of new users are created by the first upload with --auto-create-user-dirs.
+    missing = str(tmp_path / "missing")
+    assert index.rebuild([missing], ".~tmp") == {missing: (0, 0)}